@@ -1,19 +1,13 @@
 import os
-import numpy as np
 import glob
-import fire
-import pandas as pd
-from PIL import Image
-import platform
-
-# fix for windows
-if platform.system() == 'Windows':
-    print('INFO: Path to openslide ddl is manually added to the path.')
-    openslide_path = r'C:\Users\ls19k424\Documents\openslide-win64-20171122\bin'
-    os.environ['PATH'] = openslide_path + ";" + os.environ['PATH']
-import openslide
 
 from wsi_to_png import PngExtractor
+from file_matching import MATCH_REPORT_FILE_NAME, match_files, save_match_report
+from lazy_imports import import_openslide, lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+openslide = import_openslide()
 
 
 class TMAPngExtractor(PngExtractor):
@@ -21,47 +15,79 @@ class TMAPngExtractor(PngExtractor):
     This Object extracts (patches of) an mrxs file to a png format.
 
     :param file_path: string
-        path to the mrxs file with the TMA spots
+        path to the mrxs file with the TMA spots, or to a folder of TMA slides.
     :param output_path: string
         path to the output folder. The output format is the same name as the mrxs file,
         with an appendix if multiple patches are extracted.
     :param coord_csv: string
-        Path to the csv file. Expects this set of headers: "Centroid X (pixels)", "Centroid Y (pixels)", "Radius (pixels)" (in pixel values)
+        Path to the csv file, or to a folder of csv files (if file_path is a folder). Expects this set of headers:
+        "Centroid X (pixels)", "Centroid Y (pixels)", "Radius (pixels)" (in pixel values)
     :param level: int (optional)
         Level of the mrxs file that should be used for the conversion (default is 0).
     :param overwrite: overides exisiting output
     :param adjust_coord: default True. Adjusts the QuPath coordinates for the missing white border. (not necessary for ASAP extracted coordinates)
+    :param staining: Staining identifier, that would be specified right before .mrxs and .csv (e.g. CD8) (optional)
+    :param match_rule: str (optional)
+        How the csv files are matched to the slides in batch mode: 'exact', 'prefix' (default) or 'regex'
+        (see file_matching.match_files).
+    :param match_pattern: str (optional)
+        Regular expression for the 'regex' match rule.
+    :param kwargs:
+        Further optional parameters of the PngExtractor (e.g. tile_size, workers, patch_workers, output_format).
     """
 
-    def __init__(self, file_path: str, output_path: str, coord_csv: str, level: int = 0, overwrite: bool = False, adjust_coord: bool = True):
+    def __init__(self, file_path: str, output_path: str, coord_csv: str, level: int = 0, overwrite: bool = False, adjust_coord: bool = True,
+                 staining: str = '', match_rule: str = 'prefix', match_pattern: str = None, **kwargs):
         # initiate properties from parent class
-        super().__init__(file_path=file_path, output_path=output_path, level=level, overwrite=overwrite)
+        super().__init__(file_path=file_path, output_path=output_path, staining=staining, level=level,
+                         overwrite=overwrite, **kwargs)
         # instantiate class parameters
         self.adjust_coord = adjust_coord
         self.coord_csv = coord_csv
+        self.match_rule = match_rule
+        self.match_pattern = match_pattern
 
     # overwrite
     @property
     def coord_files(self):
         if self.coord_csv:
-            return glob.glob(os.path.join(self.coord_csv, f'*{self.staining}.xml')) if os.path.isdir(
+            return glob.glob(os.path.join(self.coord_csv, f'*{self.staining}.csv')) if os.path.isdir(
                 self.coord_csv) else [self.coord_csv]
         else:
             return None
 
+    # overwrite
+    @property
+    def job_params(self):
+        return {**super().job_params, 'adjust_coord': self.adjust_coord}
+
     # overwrite
     @property
     def files_to_process(self):
-        # we only have one file to process
-        if len(self.wsi_files) == 1:
-            filename = os.path.splitext(os.path.basename(self.file_path))[0]
+        if os.path.isfile(self.file_path):
+            # we only have one file to process
+            pairs = {self.file_path: self.coord_csv}
+        else:
+            # batch mode: pair the slides with the csv files, the same way as the ASAP tool does
+            report = match_files(self.wsi_files, self.coord_files, match_rule=self.match_rule,
+                                 match_pattern=self.match_pattern)
+            save_match_report(report, self.output_path, self.shard_file_name(MATCH_REPORT_FILE_NAME),
+                              save=not self.dry_run)
+            pairs = report['matched']
+
+        files_to_process = []
+        for wsi_path in self.select_shard(pairs):
+            coord_path = pairs[wsi_path]
+            filename = os.path.splitext(os.path.basename(wsi_path))[0]
             output_file_name = os.path.join(self.output_path,
-                                            f'{filename}-level{self.level}-TMAid')
+                                            f'{filename}-{self.resolution_name}-TMAid')
+            job = (output_file_name, wsi_path, coord_path)
             # skip existing files, if overwrite = False
-            if not self.overwrite and os.path.isfile(f'{output_file_name}.png'):
+            if self.is_processed(job):
                 print(f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
-            else:
-                return output_file_name, self.file_path, self.coord_csv
+                continue
+            files_to_process.append(job)
+        return files_to_process
 
     def _crop_wsi(self, wsi):
         # This function crops the white space around the WSI away, so that it fits together with the
@@ -71,67 +97,91 @@ class TMAPngExtractor(PngExtractor):
         dim = (int(int(x)), int(int(y)))
         w, h = wsi.properties[openslide.PROPERTY_NAME_BOUNDS_WIDTH], wsi.properties[
             openslide.PROPERTY_NAME_BOUNDS_HEIGHT]
-        wh = (int(int(w) / 2 ** self.level), int(int(h) / 2 ** self.level))
+        downsample = wsi.level_downsamples[self.level]
+        wh = (int(int(w) / downsample), int(int(h) / downsample))
         return wsi.read_region(location=dim, level=self.level, size=wh)
 
     # overwrite
     def process_files(self):
-        # process the files with coordinates
-        if os.path.isfile(self.file_path) and os.path.isfile(self.coord_csv):
-            output_file_path_prefix, mrxs_path, coord_path = self.files_to_process
-            assert os.path.isfile(mrxs_path)
-            wsi_img = openslide.open_slide(mrxs_path)
-            if self.adjust_coord:
-                x, y = wsi_img.properties[openslide.PROPERTY_NAME_BOUNDS_X], wsi_img.properties[openslide.PROPERTY_NAME_BOUNDS_Y]
-                coords = self.parse_csv(coord_path, adjust_x=int(x), adjust_y=int(y))
-            else:
-                coords = self.parse_csv(coord_path)
-            # iterate over the patch-coordinates(s)
-            for tma_id, coord in coords:
-                output_file_path = f'{output_file_path_prefix}{tma_id}.png'
-                # skip existing files, if overwrite = False
-                if not self.overwrite and os.path.isfile(output_file_path):
-                    print(f'File {output_file_path} already exists. Output saving is skipped. To overwrite add --overwrite.')
-                else:
-                    # extract the patch
-                    # coord = [[12578.9619, 43432.1758], [15987.166, 43432.1758], [15987.166, 46571.3086], [12578.9619, 46571.3086]]
-                    png = self.extract_crop(wsi_img, coord)
-                    # save the image
-                    print(f'Saving image {output_file_path}')
-                    Image.fromarray(png[:, :, :3]).save(output_file_path)
+        # process the files with coordinates (a single slide and csv file, or folders of them)
+        if ((os.path.isfile(self.file_path) and os.path.isfile(self.coord_csv)) or (
+                os.path.isdir(self.file_path) and os.path.isdir(self.coord_csv))):
+            return self.process_batch(self.files_to_process)
 
         else:
             # Something went wrong
             print('mrxs and/or csv file paths are invalid.')
 
+    # overwrite
+    def process_file(self, output_file_path_prefix, mrxs_path, coord_path, previous=None):
+        assert os.path.isfile(mrxs_path)
+        wsi_img = self.open_slide(mrxs_path)
+        try:
+            return self.process_patches(wsi_img, self.get_patch_jobs(wsi_img, output_file_path_prefix, coord_path),
+                                        previous)
+        finally:
+            self.close_slide(wsi_img)
+
+    def get_patch_jobs(self, wsi_img, output_file_path_prefix, coord_path):
+        # returns a list of (output file path, coordinates) of the TMA spots of a slide
+        if self.adjust_coord:
+            # slides without bounds (e.g. ndpi) do not have a border
+            x = wsi_img.properties.get(openslide.PROPERTY_NAME_BOUNDS_X, 0)
+            y = wsi_img.properties.get(openslide.PROPERTY_NAME_BOUNDS_Y, 0)
+            coords = self.parse_csv(coord_path, adjust_x=int(x), adjust_y=int(y))
+        else:
+            coords = self.parse_csv(coord_path)
+        patch_jobs = []
+        # iterate over the patch-coordinates(s)
+        for tma_id, coord in coords:
+            output_file_path = f'{output_file_path_prefix}{tma_id}{self.output_format.extension}'
+            # coord = [[12578.9619, 43432.1758], [15987.166, 43432.1758], [15987.166, 46571.3086], [12578.9619, 46571.3086]]
+            patch_jobs.append((output_file_path, coord))
+        return patch_jobs
+
     def parse_csv(self, coord_csv, adjust_x=0, adjust_y=0):
         # reads the csv file and retrieves the coordinates and the TMA spot index
         # coordinates have to be returned as [tl, tr, br, bl] ((0,0) is top-left)
+        # the bounding boxes of all spots are computed at once
         csv = pd.read_csv(coord_csv, sep=';')
-        inds_coords = [self._get_inds_coords(row, adjust_x, adjust_y) for index, row in csv.iterrows()]
-
-        return [i for i in inds_coords if i]  # remove None entries
-
-    def _get_inds_coords(self, csv_row, adjust_x=0, adjust_y=0):
-        # coordinates have to be returned as [[top-left], [top-right], [bottom-right], [bottom-left]] ((0,0) is top-left)
         # only get coordinates if there is an id
-        if not np.isnan(csv_row['Core Unique ID']):
-            c_x, c_y = csv_row['Centroid X (pixels)'], csv_row['Centroid Y (pixels)']
-            # adjust coordinates, if we work with QuPath-extracted coordinates
-            radius = csv_row['Radius (pixels)']
-            coords = [[c_x - radius + adjust_x, c_y - radius + adjust_y], [c_x + radius + adjust_x, c_y - radius + adjust_y],
-                      [c_x + radius + adjust_x, c_y + radius + adjust_y], [c_x - radius + adjust_x, c_y + radius + adjust_y]]
-            id = int(csv_row['Core Unique ID'])
-            return id, coords
-
-
-def extract_tma(file_path: str, coord_csv: str, output_path: str, level: int = 0, overwrite: bool = False, adjust_coord: bool = True):
+        csv = csv[csv['Core Unique ID'].notna()]
+        c_x = csv['Centroid X (pixels)'].to_numpy(dtype=np.float64)
+        c_y = csv['Centroid Y (pixels)'].to_numpy(dtype=np.float64)
+        radius = csv['Radius (pixels)'].to_numpy(dtype=np.float64)
+        # adjust coordinates, if we work with QuPath-extracted coordinates
+        left, right = c_x - radius + adjust_x, c_x + radius + adjust_x
+        top, bottom = c_y - radius + adjust_y, c_y + radius + adjust_y
+        # shape (number of spots, 4 corners, x / y)
+        coords = np.stack([np.stack([left, top], axis=1), np.stack([right, top], axis=1),
+                           np.stack([right, bottom], axis=1), np.stack([left, bottom], axis=1)], axis=1)
+        ids = csv['Core Unique ID'].to_numpy().astype(int)
+
+        return list(zip(ids.tolist(), coords))
+
+
+def extract_tma(file_path: str, coord_csv: str, output_path: str, level: int = 0, overwrite: bool = False, adjust_coord: bool = True,
+                tile_size: int = None, workers: int = 1, patch_workers: int = 1, encode_workers: int = 1,
+                output_format: str = 'png', compress_level: int = 6, quality: int = 90, staining: str = '',
+                match_rule: str = 'prefix', match_pattern: str = None, target_mpp: float = None,
+                downsample: float = None, coalesce: bool = False, coalesce_memory: int = 256,
+                profile: bool = False, cprofile: bool = False, dry_run: bool = False,
+                max_memory: int = None, shard_index: int = None, shard_count: int = None, shard_by: str = 'hash'):
     png_extractor = TMAPngExtractor(file_path=file_path, coord_csv=coord_csv, output_path=output_path, level=level,
-                                    overwrite=overwrite, adjust_coord=adjust_coord)
+                                    overwrite=overwrite, target_mpp=target_mpp, downsample=downsample,
+                                    adjust_coord=adjust_coord, staining=staining,
+                                    match_rule=match_rule, match_pattern=match_pattern, tile_size=tile_size,
+                                    workers=workers, patch_workers=patch_workers, encode_workers=encode_workers,
+                                    output_format=output_format, compress_level=compress_level, quality=quality,
+                                    coalesce=coalesce, coalesce_memory=coalesce_memory,
+                                    profile=profile, cprofile=cprofile, dry_run=dry_run,
+                                    max_memory=max_memory, shard_index=shard_index, shard_count=shard_count,
+                                    shard_by=shard_by)
 
     # process the files
     png_extractor.process_files()
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(extract_tma)
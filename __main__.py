@@ -0,0 +1,7 @@
+import sys
+
+from cli import main
+
+if __name__ == '__main__':
+    # python <folder of the converter> <command> [command line arguments]
+    main(name=f'python {sys.argv[0]}')
@@ -1,20 +1,14 @@
 import os
-import pandas as pd
 import glob
-import fire
 import xml.etree.ElementTree as ET
-from PIL import Image
-
-import platform
-
-# fix for windows
-if platform.system() == 'Windows':
-    print('INFO: Path to openslide ddl is manually added to the path.')
-    openslide_path = r'C:\Users\ls19k424\Documents\openslide-win64-20171122\bin'
-    os.environ['PATH'] = openslide_path + ";" + os.environ['PATH']
-import openslide
 
 from wsi_to_png import PngExtractor
+from image_utils import polygon_mask
+from file_matching import MATCH_REPORT_FILE_NAME, match_files, save_match_report
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 MATCHED_EXCEL_INFO = {'wsi_col': 'CD8 Filename', 'xml_col': 'Hotspot filename', 'sheet_name': 'BTS', 'folder_col': 'Folder'}
 # MATCHED_EXCEL_INFO = {'wsi_col': 'CD8 Filename', 'xml_col': 'Hotspot filename', 'sheet_name': 'BTS'}
@@ -41,18 +35,33 @@ class AsapPngExtractor(PngExtractor):
     :param level: int (optional)
         Level of the mrxs file that should be used for the conversion (default is 0).
     :param overwrite: overwrites existing extracted patches (default is False)
+    :param match_rule: str (optional)
+        How the xml files are matched to the mrxs files (if no matched excel is provided): 'exact' (same file name),
+        'prefix' (the xml file name starts with the mrxs file name, default) or 'regex' (see match_pattern).
+    :param match_pattern: str (optional)
+        Regular expression for the 'regex' match rule, the first group (or the whole match) has to be the same in
+        the mrxs and in the xml file name.
+    :param polygon: bool (optional)
+        If True, the annotations are exported as polygons: the bounding box is extracted and the pixels outside of
+        the annotation are white. Otherwise the bounding boxes (rectangles) are exported (default is False).
+    :param kwargs:
+        Further optional parameters of the PngExtractor (e.g. tile_size, workers, patch_workers, output_format).
     """
 
     def __init__(self, file_path: str, output_path: str, xmls_path: str, staining: str = '',
                  coord_annotation_tag: str = 'hotspot', level: int = 0, overwrite: bool = False,
-                 matched_files_excel: str = None):
+                 matched_files_excel: str = None, match_rule: str = 'prefix', match_pattern: str = None,
+                 polygon: bool = False, **kwargs):
         # initiate properties from parent class
         super().__init__(file_path=file_path, output_path=output_path, staining=staining, level=level,
-                         overwrite=overwrite)
+                         overwrite=overwrite, **kwargs)
         # instantiate class parameters
         self.xmls_path = xmls_path
         self.coord_annotation_tag = coord_annotation_tag
         self.matched_files_excel = matched_files_excel
+        self.match_rule = match_rule
+        self.match_pattern = match_pattern
+        self.polygon = polygon
 
     @property
     def xml_files(self):
@@ -74,18 +83,26 @@ class AsapPngExtractor(PngExtractor):
             files.extend(glob.glob(os.path.join(self.file_path, f'**/*{self.staining}.ndpi')))
         return files
 
+    # overwrite
+    @property
+    def job_params(self):
+        return {**super().job_params, 'tag': self.coord_annotation_tag, 'polygon': self.polygon}
+
     # overwrite
     @property
     def files_to_process(self):
-        # we only have one file to process
-        if len(self.wsi_files) == 1:
+        # we only have one file to process (a folder with a single slide is matched like any other folder)
+        if os.path.isfile(self.file_path):
+            if not self.select_shard([self.file_path]):
+                return []
             filename = os.path.splitext(os.path.basename(self.file_path))[0]
             output_file_name = os.path.join(self.output_path,
-                                            f'{filename}-level{self.level}-{self.coord_annotation_tag}')
+                                            f'{filename}-{self.resolution_name}-{self.coord_annotation_tag}')
             # skip existing files, if overwrite = False
-            if not self.overwrite and os.path.isfile(f'{output_file_name}.png'):
+            if self.is_processed((output_file_name, self.file_path, self.xmls_path)):
                 print(
                     f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
+                return []
             else:
                 return [(output_file_name, self.file_path, self.xmls_path)]
 
@@ -109,45 +126,47 @@ class AsapPngExtractor(PngExtractor):
         df = df[df[MATCHED_EXCEL_INFO['xml_col']].notna()]
         df = df.drop(df[df[MATCHED_EXCEL_INFO['xml_col']].isin(["tbd"])].index)
 
-        for wsi_file, wsi_folder, xml_name in zip(df[MATCHED_EXCEL_INFO['wsi_col']], df[MATCHED_EXCEL_INFO['folder_col']], df[MATCHED_EXCEL_INFO['xml_col']]):
+        wsi_paths = [os.path.join(self.wsi_files, os.path.join(wsi_folder, wsi_file))
+                     for wsi_file, wsi_folder in zip(df[MATCHED_EXCEL_INFO['wsi_col']], df[MATCHED_EXCEL_INFO['folder_col']])]
+        shard = set(self.select_shard(wsi_paths))
+        for wsi_path, xml_name in zip(wsi_paths, df[MATCHED_EXCEL_INFO['xml_col']]):
+            if wsi_path not in shard:
+                continue
             # filter so that only valid ones are present (e.g. based on the exclude column)
-            filename = os.path.splitext(os.path.basename(wsi_file))[0]
+            filename = os.path.splitext(os.path.basename(wsi_path))[0]
             output_file_name = os.path.join(self.output_path,
-                                            f'{filename}-level{self.level}-{self.coord_annotation_tag}')
+                                            f'{filename}-{self.resolution_name}-{self.coord_annotation_tag}')
+            job = (output_file_name, wsi_path, os.path.join(self.xmls_path, xml_name))
             # skip existing files, if overwrite = False
-            if not self.overwrite and os.path.isfile(f'{output_file_name}.png'):
+            if self.is_processed(job):
                 print(
                     f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
                 continue
-            wsi_path = os.path.join(self.wsi_files, os.path.join(wsi_folder, wsi_file))
-            # print((output_file_name, wsi_path, xml_name))
-            files_to_process.append((output_file_name, wsi_path, os.path.join(self.xmls_path, xml_name)))
+            files_to_process.append(job)
 
         return files_to_process
 
     def _match_files(self):
         # create a list of the paired mrxs and coordinate files
-        # only take files that have a corresponding coordinates file
+        # only take files that have a corresponding coordinates file, the others are listed in the match report
+        report = match_files(self.wsi_files, self.xml_files, match_rule=self.match_rule,
+                             match_pattern=self.match_pattern)
+        save_match_report(report, self.output_path, self.shard_file_name(MATCH_REPORT_FILE_NAME),
+                          save=not self.dry_run)
+
         files_to_process = []
-        for wsi_path in self.wsi_files:
+        for wsi_path in self.select_shard(report['matched']):
+            coord_file = report['matched'][wsi_path]
             filename = os.path.splitext(os.path.basename(wsi_path))[0]
             output_file_name = os.path.join(self.output_path,
-                                            f'{filename}-level{self.level}-{self.coord_annotation_tag}')
+                                            f'{filename}-{self.resolution_name}-{self.coord_annotation_tag}')
+            job = (output_file_name, wsi_path, coord_file)
             # skip existing files, if overwrite = False
-            if not self.overwrite and os.path.isfile(f'{output_file_name}.png'):
+            if self.is_processed(job):
                 print(
                     f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
                 continue
-
-            checked = []
-            for coord_file in self.xml_files:
-                if filename in coord_file:
-                    checked.append(coord_file)
-            if len(checked) != 1:
-                print(
-                    f'File {filename}.mrxs/.ndpi does not have a / too many corresponding xml file/s. File will be skipped.')
-            else:
-                files_to_process.append((output_file_name, wsi_path, checked.pop()))
+            files_to_process.append(job)
 
         return files_to_process
 
@@ -156,63 +175,101 @@ class AsapPngExtractor(PngExtractor):
         # process the files with coordinates
         if ((os.path.isdir(self.file_path) and os.path.isdir(self.xmls_path)) or (
                 os.path.isfile(self.file_path) and os.path.isfile(self.xmls_path))):
-
-            for output_file_path, mrxs_path, coord_path in self.files_to_process:
-                assert os.path.isfile(mrxs_path)
-                wsi_img = openslide.open_slide(mrxs_path)
-                coords = self.parse_xml(coord_path)
-                # iterate over the patch-coordinates(s)
-                for i, coord in enumerate(coords):
-                    appendix = f'-{i}' if len(coords) > 1 else ''
-                    output_file_path = f'{output_file_path}{appendix}.png'
-                    # skip existing files, if overwrite = False
-                    if not self.overwrite and os.path.isfile(output_file_path):
-                        print(
-                            f'File {output_file_path} already exists. Output saving is skipped. To overwrite add --overwrite.')
-                    else:
-                        # extract the patch
-                        png = self.extract_crop(wsi_img, coord)
-                        # save the image
-                        print(f'Saving image {output_file_path}')
-                        Image.fromarray(png[:, :, :3]).save(output_file_path)
+            return self.process_batch(self.files_to_process)
 
         else:
             # Something went wrong
             print('mrxs and/or xml file paths are invalid.')
 
-    def parse_xml(self, file_path):
-        # reads the xml files and retrieves the coordinates of all elements with the coord_annotation_tag
-        tree = ET.parse(file_path)
-        root = tree.getroot()
+    # overwrite
+    def process_file(self, output_file_path, mrxs_path, coord_path, previous=None):
+        assert os.path.isfile(mrxs_path)
+        wsi_img = self.open_slide(mrxs_path)
+        try:
+            return self.process_patches(wsi_img, self.get_patch_jobs(wsi_img, output_file_path, coord_path), previous)
+        finally:
+            self.close_slide(wsi_img)
 
-        groups = [self.coord_annotation_tag]
-        annotations_elements = {g: [] for g in groups}
+    def get_patch_jobs(self, wsi_img, output_file_path, coord_path):
+        # returns a list of (output file path, coordinates) of the patches of a slide
+        patch_jobs = []
+        coords = self.parse_xml(coord_path)
+        # iterate over the patch-coordinates(s)
+        for i, coord in enumerate(coords):
+            appendix = f'-{i}' if len(coords) > 1 else ''
+            patch_jobs.append((f'{output_file_path}{appendix}{self.output_format.extension}', coord))
+        return patch_jobs
 
-        for i in root.iter('Annotation'):
-            annotations_elements[i.attrib['PartOfGroup']].append(i)
+    # overwrite
+    def mask_region(self, img, wsi_img, coord, top_left_coord, id_level, row_offset=0):
+        # in polygon mode, the pixels outside of the annotation become white
+        if not self.polygon or coord is None:
+            return img
+        # downsample of the (resized) region
+        downsample = self.get_target_downsample(wsi_img)
+        # vertices in pixel coordinates of the rows in img
+        vertices = (np.asarray(coord, dtype=np.float64) - top_left_coord) / downsample - [0, row_offset]
+        img[~polygon_mask(vertices, img.shape[1], img.shape[0])] = 255
+        return img
 
+    def parse_xml(self, file_path):
+        # reads the xml files and retrieves the coordinates of all elements with the coord_annotation_tag
+        return self.parse_xml_groups(file_path, [self.coord_annotation_tag])[self.coord_annotation_tag]
+
+    def parse_xml_groups(self, file_path, groups):
+        # reads the xml file incrementally and returns a dictionary with the coordinates of the annotations of every
+        # group in groups, as (n, 2) numpy arrays ([x, y] arrays for dots). Annotations of other groups are skipped
+        # and every annotation is freed as soon as it is read, so also files with many annotations fit in memory.
         annotations = {g: [] for g in groups}
-        for group, element_list in annotations_elements.items():
-            for element in element_list:
-                if element.attrib['Type'] == 'Dot':
-                    annotations[group].append(
-                        [[float(i.attrib['X']), float(i.attrib['Y'])] for i in element.iter('Coordinate')][0])
-                else:
-                    annotations[group].append(
-                        [[float(i.attrib['X']), float(i.attrib['Y'])] for i in element.iter('Coordinate')])
+        # path from the root to the current element
+        elements = []
+        group, points = None, []
+        for event, element in ET.iterparse(file_path, events=('start', 'end')):
+            if event == 'start':
+                elements.append(element)
+                if element.tag == 'Annotation':
+                    group, points = element.attrib.get('PartOfGroup'), []
+                continue
+
+            elements.pop()
+            if element.tag == 'Coordinate' and group in annotations:
+                points.append((float(element.attrib['X']), float(element.attrib['Y'])))
+            elif element.tag == 'Annotation':
+                if group in annotations:
+                    coords = np.array(points, dtype=np.float64).reshape(-1, 2)
+                    annotations[group].append(coords[0] if element.attrib['Type'] == 'Dot' else coords)
+                group, points = None, []
+                # free the annotation (the parent only ever holds the current one)
+                element.clear()
+                if elements:
+                    elements[-1].remove(element)
 
-        return annotations[self.coord_annotation_tag]
+        return annotations
 
 
 def extract_patch(file_path: str, output_path: str, xmls_path: str, staining: str = '',
                   coord_annotation_tag: str = 'hotspot',
-                  level: int = 0, overwrite: bool = False, matched_files_excel: str = None):
+                  level: int = 0, overwrite: bool = False, matched_files_excel: str = None, tile_size: int = None,
+                  workers: int = 1, patch_workers: int = 1, encode_workers: int = 1, output_format: str = 'png',
+                  compress_level: int = 6, quality: int = 90, match_rule: str = 'prefix', match_pattern: str = None,
+                  polygon: bool = False, target_mpp: float = None, downsample: float = None, coalesce: bool = False,
+                  coalesce_memory: int = 256, profile: bool = False, cprofile: bool = False, dry_run: bool = False,
+                  max_memory: int = None, shard_index: int = None, shard_count: int = None, shard_by: str = 'hash'):
     png_extractor = AsapPngExtractor(file_path=file_path, output_path=output_path, staining=staining, level=level,
-                                     overwrite=overwrite, xmls_path=xmls_path,
-                                     coord_annotation_tag=coord_annotation_tag, matched_files_excel=matched_files_excel)
+                                     overwrite=overwrite, target_mpp=target_mpp, downsample=downsample,
+                                     xmls_path=xmls_path,
+                                     coord_annotation_tag=coord_annotation_tag, matched_files_excel=matched_files_excel,
+                                     tile_size=tile_size, workers=workers, patch_workers=patch_workers,
+                                     encode_workers=encode_workers, output_format=output_format,
+                                     compress_level=compress_level, quality=quality, match_rule=match_rule,
+                                     match_pattern=match_pattern, polygon=polygon, coalesce=coalesce,
+                                     coalesce_memory=coalesce_memory, profile=profile, cprofile=cprofile,
+                                     dry_run=dry_run, max_memory=max_memory, shard_index=shard_index,
+                                     shard_count=shard_count, shard_by=shard_by)
     # process the files
     png_extractor.process_files()
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(extract_patch)
@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import resource
+import tempfile
+import subprocess
+import fire
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, REPO_PATH)
+
+from suite import DATA_PATH, SIZES, fixtures
+
+
+def _max_rss():
+    # peak resident set size in bytes (linux reports kilobytes)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_variant(variant: str, size: str = 'small', data_path: str = DATA_PATH):
+    # reads the whole level 0 of the slide with read_rgb (in strips or at once) and prints the peak memory that was
+    # added by it (in its own process, so the peak memory of the other variant does not interfere)
+    import wsi_to_png
+    from lazy_imports import import_openslide
+    if variant == 'at_once':
+        wsi_to_png.READ_STRIP_PIXELS = 2 ** 62
+    wsi_img = import_openslide().open_slide(os.path.join(data_path, size, 'slide.tif'))
+    extractor = wsi_to_png.PngExtractor(os.path.join(data_path, size, 'slide.tif'), tempfile.mkdtemp())
+    # warm-up: libraries and the openslide tile cache
+    extractor.read_rgb(wsi_img, (0, 0), 0, (256, 256))
+    baseline = _max_rss()
+    img = extractor.read_rgb(wsi_img, (0, 0), 0, wsi_img.dimensions)
+    print(json.dumps({'variant': variant, 'pixels': img.shape[0] * img.shape[1],
+                      'peak_added_bytes': _max_rss() - baseline}))
+
+
+def run(size: str = 'small', data_path: str = DATA_PATH):
+    """
+    Measures the peak memory (RSS) that read_rgb adds per pixel when it reads level 0 of the synthetic slide of the
+    size (see suite.SIZES) at once and in strips, and compares it with the constants of the memory estimate
+    (region_planner.READ_BYTES_PER_PIXEL, RGB_BYTES_PER_PIXEL and OPENSLIDE_CACHE_BYTES).
+    """
+    from region_planner import OPENSLIDE_CACHE_BYTES, READ_BYTES_PER_PIXEL, RGB_BYTES_PER_PIXEL
+    from wsi_to_png import READ_STRIP_PIXELS
+    fixtures(size, data_path)
+    results = {}
+    for variant in ['at_once', 'strips']:
+        output = subprocess.run([sys.executable, __file__, 'run_variant', variant, size, '--data_path', data_path],
+                                check=True, capture_output=True, text=True).stdout
+        results[variant] = json.loads(output.strip().splitlines()[-1])
+    width, height = SIZES[size]
+    at_once, strips = results['at_once'], results['strips']
+    print(f'{size} slide ({width} x {height} pixels) read at once: '
+          f'{at_once["peak_added_bytes"] / at_once["pixels"]:.1f} bytes per pixel '
+          f'(READ_BYTES_PER_PIXEL = {READ_BYTES_PER_PIXEL})')
+    overhead = strips['peak_added_bytes'] - RGB_BYTES_PER_PIXEL * strips['pixels']
+    estimate = READ_STRIP_PIXELS * READ_BYTES_PER_PIXEL + OPENSLIDE_CACHE_BYTES
+    print(f'read in strips: {strips["peak_added_bytes"] / strips["pixels"]:.1f} bytes per pixel, '
+          f'{overhead / 2 ** 20:.0f} MB besides the RGB output (estimated {estimate / 2 ** 20:.0f} MB with the '
+          f'openslide cache)')
+
+if __name__ == '__main__':
+    fire.Fire({'run': run, 'run_variant': run_variant})
@@ -0,0 +1,119 @@
+import os
+import sys
+import tempfile
+import fire
+import numpy as np
+from PIL import Image
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, REPO_PATH)
+
+from image_utils import polygon_mask
+from output_writers import StreamingPngWriter
+from region_planner import box_pixels, count_tiles, plan_regions, union_box
+
+
+def _test_image(rng, width, height):
+    # noise, gradients (which the sub, up, average and paeth filters predict well) and flat areas
+    img = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    x, y = np.meshgrid(np.arange(width), np.arange(height))
+    img[height // 3:] = np.stack([x, y, x + y], axis=2)[height // 3:] % 256
+    img[2 * height // 3:, width // 2:] = 200
+    return img
+
+
+def check_png_writer(images=20, seed=0):
+    # streams images of random sizes in blocks of random numbers of rows and compares the decoded png with the input
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as temp_path:
+        file_path = os.path.join(temp_path, 'image.png')
+        # the last image is larger than FILTER_BLOCK_BYTES, so write_rows filters it in several blocks
+        sizes = [tuple(rng.integers(1, 300, size=2)) for _ in range(images - 1)] + [(1000, 400)]
+        for width, height in sizes:
+            img = _test_image(rng, int(width), int(height))
+            with StreamingPngWriter(file_path, img.shape[1], img.shape[0]) as writer:
+                start = 0
+                while start < img.shape[0]:
+                    rows = int(rng.integers(1, img.shape[0] - start + 1))
+                    writer.write_rows(img[start:start + rows])
+                    start += rows
+            with Image.open(file_path) as png:
+                if png.mode != 'RGB' or not np.array_equal(np.asarray(png), img):
+                    raise RuntimeError(f'The streamed png of {img.shape[1]} x {img.shape[0]} pixels differs from '
+                                       f'the input.')
+    print(f'StreamingPngWriter: {len(sizes)} images are identical.')
+
+
+def _reference_polygon_mask(vertices, width, height):
+    # the pixels whose center is inside the polygon (even-odd rule), tested one by one with a ray to the left (a
+    # center on an edge is decided by the crossings left of it, as in polygon_mask)
+    mask = np.zeros((height, width), dtype=bool)
+    for row in range(height):
+        for col in range(width):
+            x, y = col + 0.5, row + 0.5
+            inside = False
+            for (x0, y0), (x1, y1) in zip(vertices, np.roll(vertices, -1, axis=0)):
+                if (y0 <= y) != (y1 <= y) and x > x0 + (y - y0) * (x1 - x0) / (y1 - y0):
+                    inside = not inside
+            mask[row, col] = inside
+    return mask
+
+
+def check_polygon_mask(polygons=50, seed=0):
+    # random (also self-intersecting) polygons, partly outside of the image, every other one with integer vertices
+    # (with horizontal edges and crossings at the pixel centers)
+    rng = np.random.default_rng(seed)
+    for i in range(polygons):
+        width, height = (int(n) for n in rng.integers(1, 40, size=2))
+        vertices = rng.uniform(-10, 50, size=(int(rng.integers(3, 12)), 2))
+        if i % 2:
+            vertices = np.round(vertices * 2) / 2
+        if not np.array_equal(polygon_mask(vertices, width, height),
+                              _reference_polygon_mask(vertices, width, height)):
+            raise RuntimeError(f'The mask of the polygon {vertices.tolist()} ({width} x {height} pixels) differs from '
+                               f'the reference.')
+    print(f'polygon_mask: {polygons} masks are identical.')
+
+
+def check_plan_regions(plans=200, seed=0):
+    # random regions (some of them overlapping or sharing tiles): every region has to be read exactly once, and a
+    # combined read has to decode fewer tiles than the separate reads of its regions and, together with its regions,
+    # respect max_pixels
+    rng = np.random.default_rng(seed)
+    for _ in range(plans):
+        tile_size = tuple(int(n) for n in rng.choice([128, 256, 512], size=2))
+        max_pixels = int(rng.integers(1, 20)) * 2 ** 18
+        boxes = []
+        for _ in range(int(rng.integers(0, 30))):
+            x0, y0 = (int(n) for n in rng.integers(0, 4000, size=2))
+            width, height = (int(n) for n in rng.integers(1, 1500, size=2))
+            boxes.append((x0, y0, x0 + width, y0 + height))
+        groups = plan_regions(boxes, tile_size, max_pixels)
+        if sorted(i for group in groups for i in group) != list(range(len(boxes))):
+            raise RuntimeError(f'The groups {groups} do not contain every one of the {len(boxes)} regions once.')
+        for group in groups:
+            if len(group) == 1:
+                continue
+            box = boxes[group[0]]
+            for i in group[1:]:
+                box = union_box(box, boxes[i])
+            if box_pixels(box) + sum(box_pixels(boxes[i]) for i in group) > max_pixels:
+                raise RuntimeError(f'The combined read {box} and its regions have more than {max_pixels} pixels.')
+            if count_tiles(box, tile_size) >= sum(count_tiles(boxes[i], tile_size) for i in group):
+                raise RuntimeError(f'The combined read {box} does not decode fewer tiles than its regions.')
+    print(f'plan_regions: {plans} plans are valid.')
+
+
+def run(seed: int = 0):
+    """
+    Checks the optimized code paths against simple reference implementations on random inputs, fails at the
+    first difference.
+    """
+    check_png_writer(seed=seed)
+    check_polygon_mask(seed=seed)
+    check_plan_regions(seed=seed)
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run})
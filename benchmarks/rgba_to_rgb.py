@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+import fire
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from image_utils import rgba_to_rgb
+
+
+def _read_region(size):
+    # stands in for openslide read_region: an RGBA image with a transparent border
+    img = np.full((size, size, 4), 200, dtype=np.uint8)
+    img[:size // 10, :, 3] = 0
+    return Image.fromarray(img, mode='RGBA')
+
+
+def _legacy(img):
+    # conversion as it was done in extract_crop and process_files before
+    img = np.array(img)
+    img[img[:, :, 3] != 255] = 255
+    return Image.fromarray(img[:, :, :3])
+
+
+def _one_pass(img):
+    return Image.fromarray(rgba_to_rgb(img))
+
+
+def _max_rss():
+    # peak resident set size in bytes (linux reports kilobytes)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_variant(variant: str, size: int):
+    # runs a single conversion and prints the time and the peak memory that was added by it
+    # (in its own process, so the peak memory of the other variant does not interfere)
+    convert = {'legacy': _legacy, 'one_pass': _one_pass}[variant]
+    img = _read_region(size)
+    baseline = _max_rss()
+    start = time.perf_counter()
+    result = convert(img)
+    duration = time.perf_counter() - start
+    del result
+    print(json.dumps({'variant': variant, 'size': size, 'seconds': duration,
+                      'peak_added_mb': (_max_rss() - baseline) / 2 ** 20,
+                      'rgba_mb': size * size * 4 / 2 ** 20}))
+
+
+def compare(size: int = 8000, repeats: int = 3):
+    """
+    Compares the time and the peak memory of the old RGBA to RGB conversion with rgba_to_rgb on a size x size image.
+    Each measurement runs in a fresh process.
+    """
+    for variant in ['legacy', 'one_pass']:
+        results = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, __file__, 'run_variant', variant, str(size)],
+                                    check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        print(f'{variant:>8}: {min(r["seconds"] for r in results):.3f} s, '
+              f'peak +{min(r["peak_added_mb"] for r in results):.0f} MB '
+              f'(RGBA input {results[0]["rgba_mb"]:.0f} MB)')
+
+
+if __name__ == '__main__':
+    fire.Fire({'compare': compare, 'run_variant': run_variant})
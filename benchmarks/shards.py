@@ -0,0 +1,96 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import fire
+import numpy as np
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, REPO_PATH)
+
+from suite import DATA_PATH, _split, make_slide
+from sharding import merge_shards
+from lazy_imports import import_openslide
+
+openslide = import_openslide()
+
+# the synthetic slides have random sizes between these numbers of tiles (of 256 pixels) per side
+MIN_TILES, MAX_TILES = 4, 24
+
+
+def make_slides(folder, slides, seed=0):
+    # synthetic slides of random sizes. They are generic tiffs, saved with the ndpi extension so the converters pick
+    # them up from the folder (OpenSlide detects the format by the content of the file).
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    for i in range(slides):
+        width, height = rng.integers(MIN_TILES, MAX_TILES + 1, size=2) * 256
+        slide_path = os.path.join(folder, f'slide{i:03d}.ndpi')
+        if not os.path.isfile(slide_path):
+            make_slide(slide_path, int(width), int(height))
+    return sorted(os.path.join(folder, f'slide{i:03d}.ndpi') for i in range(slides))
+
+
+def run(slides: int = 12, shard_count: int = 3, shard_by: str = 'hash,cost', level: int = 0, seed: int = 0,
+        data_path: str = os.path.join(DATA_PATH, 'shards')):
+    """
+    Checks the sharding locally: converts a folder of synthetic slides of random sizes with shard_count shards,
+    each in its own process (started at the same time, as on the nodes of a cluster), merges the shards and prints
+    the slides, megapixels and time of every shard for every strategy (comma separated, 'hash' and/or 'cost').
+    Fails if a slide is processed by none or by several shards.
+    """
+    # the converters take every slide of the folder, so it holds exactly the slides of this run
+    folder = os.path.join(data_path, f'seed{seed}-slides{slides}')
+    wsi_paths = make_slides(folder, slides, seed)
+    pixels = {}
+    for wsi_path in wsi_paths:
+        wsi_img = openslide.open_slide(wsi_path)
+        width, height = wsi_img.level_dimensions[min(level, wsi_img.level_count - 1)]
+        pixels[os.path.splitext(os.path.basename(wsi_path))[0]] = width * height
+        wsi_img.close()
+
+    for strategy in _split(shard_by):
+        output_path = tempfile.mkdtemp(prefix=f'shards-{strategy}-')
+        try:
+            start = time.perf_counter()
+            processes = [subprocess.Popen([sys.executable, os.path.join(REPO_PATH, 'cli.py'), 'whole', folder,
+                                           output_path, '--level', str(level), '--shard-index', str(i),
+                                           '--shard-count', str(shard_count), '--shard-by', strategy],
+                                          stdout=subprocess.DEVNULL)
+                         for i in range(shard_count)]
+            # time of every shard (until its process finished)
+            seconds = [None] * shard_count
+            while None in seconds:
+                for i, process in enumerate(processes):
+                    if seconds[i] is None and process.poll() is not None:
+                        if process.returncode != 0:
+                            raise RuntimeError(f'Shard {i} failed with exit code {process.returncode}.')
+                        seconds[i] = time.perf_counter() - start
+                time.sleep(0.05)
+            total_seconds = time.perf_counter() - start
+
+            # every slide has to be processed by exactly one shard
+            shards = []
+            for i in range(shard_count):
+                with open(os.path.join(output_path, f'manifest.shard-{i}-of-{shard_count}.json')) as f:
+                    shards.append({key.rsplit('-', 1)[0] for key in json.load(f)['slides']})
+            processed = [name for shard in shards for name in shard]
+            if sorted(processed) != sorted(pixels):
+                raise RuntimeError('The shards do not cover every slide exactly once.')
+            merge_shards(output_path)
+
+            megapixels = [sum(pixels[name] for name in shard) / 1e6 for shard in shards]
+            print(f'\n{strategy}: {slides} slides, {shard_count} shards, {total_seconds:.1f} s')
+            for i, shard in enumerate(shards):
+                print(f'    shard {i}: {len(shard):3d} slides {megapixels[i]:8.1f} MP {seconds[i]:6.1f} s')
+            print(f'    largest shard / mean: {max(megapixels) / np.mean(megapixels):.2f} (megapixels)')
+        finally:
+            shutil.rmtree(output_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run})
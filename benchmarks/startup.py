@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+import fire
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+RESULTS_PATH = os.path.join(BENCHMARK_PATH, 'results')
+sys.path.insert(0, BENCHMARK_PATH)
+
+from suite import make_asap_xml, make_slide, make_tma_csv
+
+# entry point: command line (relative to the repository), the scripts of the base are measured as well
+SCRIPTS = {'whole': ['wsi_to_png.py'], 'asap': ['asap_to_png.py'], 'tma': ['TMA_to_png.py']}
+CLI = {command: ['cli.py', command] for command in SCRIPTS}
+# arguments of a job without input files: the startup (interpreter, imports, argument parsing) is all that runs
+ARGUMENTS = {'whole': ['missing.tif', '{output}'], 'asap': ['missing.tif', '{output}', 'missing.xml'],
+             'tma': ['missing.tif', 'missing.csv', '{output}']}
+# arguments of a job on a tiny slide: the startup and the first use of numpy, PIL and openslide
+SLIDE_ARGUMENTS = {'whole': ['{slide}', '{output}', '--overwrite'],
+                   'asap': ['{slide}', '{output}', '{xml}', '--overwrite'],
+                   'tma': ['{slide}', '{csv}', '{output}', '--overwrite', '--adjust_coord=False']}
+SCENARIOS = {'startup': ARGUMENTS, 'slide': SLIDE_ARGUMENTS}
+# size of the tiny slide (a single level)
+SLIDE_SIZE = (1024, 768)
+
+
+def _git(*args, **kwargs):
+    return subprocess.run(['git', *args], cwd=REPO_PATH, check=True, capture_output=True, **kwargs).stdout
+
+
+def _time(repo_path, command_line, arguments, repeats, output_path, data_path):
+    # wall times (in seconds) of running the command line in a fresh interpreter
+    arguments = [argument.format(output=output_path, slide=os.path.join(data_path, 'slide.tif'),
+                                 xml=os.path.join(data_path, 'slide.xml'), csv=os.path.join(data_path, 'slide.csv'))
+                 for argument in arguments]
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(repo_path, command_line[0]), *command_line[1:], *arguments],
+                       cwd=output_path, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def run(base: str = 'HEAD', repeats: int = 10, save: bool = False, results_path: str = RESULTS_PATH):
+    """
+    Measures the startup time of the converters in a fresh interpreter: a job without input files (imports and
+    argument parsing) and a job on a tiny synthetic slide (which also loads numpy, PIL and openslide), for the scripts
+    of the base commit, and the scripts and the cli of the working tree.
+
+    :param base: string (optional)
+        git commit of the scripts to compare with (default is HEAD).
+    :param repeats: int (optional)
+        number of runs per entry point, the median and the minimum are reported (default is 10).
+    :param save: bool (optional)
+        If set, the results are saved to results_path/startup-<commit>.json.
+    """
+    # fire parses an all-digit commit hash as a number
+    base = str(base)
+    with tempfile.TemporaryDirectory() as temp_path:
+        base_path = os.path.join(temp_path, 'base')
+        os.makedirs(base_path)
+        archive = _git('archive', '--format=tar', base)
+        subprocess.run(['tar', '-x', '-C', base_path], input=archive, check=True)
+        output_path = os.path.join(temp_path, 'output')
+        os.makedirs(output_path)
+        data_path = os.path.join(temp_path, 'data')
+        os.makedirs(data_path)
+        make_slide(os.path.join(data_path, 'slide.tif'), *SLIDE_SIZE)
+        make_asap_xml(os.path.join(data_path, 'slide.xml'), *SLIDE_SIZE, regions=False)
+        make_tma_csv(os.path.join(data_path, 'slide.csv'), *SLIDE_SIZE)
+
+        entries = {}
+        for scenario, arguments in SCENARIOS.items():
+            for command in SCRIPTS:
+                entries[f'{command} {scenario} base script'] = (base_path, SCRIPTS[command], arguments[command])
+                entries[f'{command} {scenario} script'] = (REPO_PATH, SCRIPTS[command], arguments[command])
+                entries[f'{command} {scenario} cli'] = (REPO_PATH, CLI[command], arguments[command])
+        # one warm-up run per entry point (file system cache, byte code)
+        for repo_path, command_line, arguments in entries.values():
+            _time(repo_path, command_line, arguments, 1, output_path, data_path)
+        results = {}
+        for name, (repo_path, command_line, arguments) in entries.items():
+            times = _time(repo_path, command_line, arguments, repeats, output_path, data_path)
+            results[name] = {'median': times[len(times) // 2], 'min': times[0]}
+
+    print(f'{"entry point":>26} {"median":>9} {"min":>9}   vs base')
+    for name, result in results.items():
+        base_result = results[' '.join(name.split()[:2] + ['base', 'script'])]
+        print(f'{name:>26} {result["median"] * 1000:7.0f}ms {result["min"] * 1000:7.0f}ms   '
+              f'{result["median"] / base_result["median"]:5.2f}x')
+
+    if save:
+        commit = _git('rev-parse', '--short', 'HEAD', text=True).strip()
+        if not os.path.isdir(results_path):
+            os.makedirs(results_path)
+        with open(os.path.join(results_path, f'startup-{commit}.json'), 'w') as f:
+            json.dump({'base': base, 'python': sys.version, 'repeats': repeats, 'results': results}, f, indent=1)
+
+
+if __name__ == '__main__':
+    fire.Fire({'run': run})
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import resource
+import tempfile
+import subprocess
+import contextlib
+import fire
+import numpy as np
+
+BENCHMARK_PATH = os.path.dirname(os.path.abspath(__file__))
+REPO_PATH = os.path.dirname(BENCHMARK_PATH)
+sys.path.insert(0, REPO_PATH)
+
+DATA_PATH = os.path.join(BENCHMARK_PATH, 'data')
+RESULTS_PATH = os.path.join(BENCHMARK_PATH, 'results')
+# level 0 dimensions (width, height) of the synthetic slides
+SIZES = {'small': (8192, 6144), 'medium': (24576, 18432), 'large': (49152, 36864)}
+TILE_SIZE = 256
+MPP = 0.25
+# TMA grid of the synthetic slides (columns, rows), the cores are circles in the cells of the grid
+TMA_GRID = (8, 6)
+# scenario: (function, arguments), the paths are added by run_scenario
+SCENARIOS = {
+    'whole_level2': ('extract_whole_slide', {'level': 2}),
+    'whole_level0_tiled': ('extract_whole_slide', {'level': 0, 'tile_size': 4096}),
+    'asap_rectangles': ('extract_patch', {'coord_annotation_tag': 'hotspot'}),
+    'asap_polygons': ('extract_patch', {'coord_annotation_tag': 'region', 'polygon': True}),
+    'tma': ('extract_tma', {'adjust_coord': False}),
+    'tma_coalesced': ('extract_tma', {'adjust_coord': False, 'coalesce': True}),
+}
+
+
+def _cores(width, height):
+    # centers (x, y) and radius of the TMA cores in level 0 pixels
+    cell_width, cell_height = width / TMA_GRID[0], height / TMA_GRID[1]
+    radius = 0.4 * min(cell_width, cell_height)
+    centers = [((i + 0.5) * cell_width, (j + 0.5) * cell_height) for j in range(TMA_GRID[1]) for i in range(TMA_GRID[0])]
+    return centers, radius
+
+
+def _render(x0, y0, width, height, downsample, slide_width, slide_height):
+    # pixels of the region (x0, y0, width, height) on a level with the given downsample. The image is a function of
+    # the level 0 coordinates, so all the levels show the same cores and every tile can be rendered on its own.
+    ys, xs = np.mgrid[y0:y0 + height, x0:x0 + width]
+    xs, ys = (xs * downsample).astype(np.int64), (ys * downsample).astype(np.int64)
+    tissue = np.zeros((height, width), dtype=bool)
+    centers, radius = _cores(slide_width, slide_height)
+    for cx, cy in centers:
+        # only the cores that overlap the region
+        if (cx + radius < xs[0, 0] or cx - radius > xs[0, -1] or
+                cy + radius < ys[0, 0] or cy - radius > ys[-1, 0]):
+            continue
+        tissue |= (xs - cx) ** 2 + (ys - cy) ** 2 < radius ** 2
+    # deterministic texture (hash of the coordinates, so it does not compress much better than real tissue)
+    noise = (xs * 0x9E3779B1 + ys * 0x85EBCA77) & 0xFFFFFFFF
+    noise ^= noise >> 15
+    noise = (noise * 0x2C1B3C6D) & 0xFFFFFFFF
+    noise = (noise ^ (noise >> 12)) & 63
+    img = np.full((height, width, 3), 242, dtype=np.uint8)
+    img[..., 0][tissue] = (170 + noise[tissue]).astype(np.uint8)
+    img[..., 1][tissue] = (80 + noise[tissue]).astype(np.uint8)
+    img[..., 2][tissue] = (150 + noise[tissue] // 2).astype(np.uint8)
+    return img
+
+
+def make_slide(file_path, width, height):
+    """
+    Writes a synthetic tiled pyramidal tiff (zlib compressed, every level half the size of the previous one, as long
+    as it is larger than 1024 pixels) that OpenSlide opens as generic tiff. The tiles are rendered one by one.
+    """
+    import tifffile
+    temp_path = f'{file_path}.partial'
+    with tifffile.TiffWriter(temp_path, bigtiff=True) as writer:
+        level, downsample = 0, 1
+        while True:
+            level_width, level_height = width // downsample, height // downsample
+            tiles = (_render(x, y, TILE_SIZE, TILE_SIZE, downsample, width, height)
+                     for y in range(0, level_height, TILE_SIZE) for x in range(0, level_width, TILE_SIZE))
+            resolution = 1e4 / (MPP * downsample)
+            writer.write(tiles, shape=(level_height, level_width, 3), dtype=np.uint8, tile=(TILE_SIZE, TILE_SIZE),
+                         photometric='rgb', compression='zlib', subfiletype=1 if level else 0,
+                         resolution=(resolution, resolution), resolutionunit='CENTIMETER')
+            if max(level_width, level_height) // 2 < 1024:
+                break
+            level, downsample = level + 1, downsample * 2
+    os.replace(temp_path, file_path)
+
+
+def make_asap_xml(file_path, width, height, regions=True):
+    # rectangles around every other core (group 'hotspot', some of them overlapping their neighbour) and octagons
+    # inside the other cores (group 'region', left out if regions is False: the original scripts only read xml files
+    # without other groups)
+    centers, radius = _cores(width, height)
+    annotations = []
+    for i, (cx, cy) in enumerate(centers):
+        if i % 2 and not regions:
+            continue
+        if i % 2 == 0:
+            r = radius * (1.4 if i % 4 == 0 else 1.)
+            # the enlarged rectangles of the outer cores are cut at the border of the slide
+            x0, y0, x1, y1 = max(0., cx - r), max(0., cy - r), min(width - 1., cx + r), min(height - 1., cy + r)
+            points = [(x0, y0), (x1, y0), (x1, y1), (x0, y1)]
+            group, kind = 'hotspot', 'Rectangle'
+        else:
+            angles = np.arange(8) * np.pi / 4
+            points = list(zip(cx + 0.9 * radius * np.cos(angles), cy + 0.9 * radius * np.sin(angles)))
+            group, kind = 'region', 'Polygon'
+        coordinates = ''.join(f'<Coordinate Order="{j}" X="{x:.2f}" Y="{y:.2f}" />' for j, (x, y) in enumerate(points))
+        annotations.append(f'<Annotation Name="Annotation {i}" Type="{kind}" PartOfGroup="{group}" Color="#F4FA58">'
+                           f'<Coordinates>{coordinates}</Coordinates></Annotation>')
+    with open(file_path, 'w') as f:
+        f.write('<?xml version="1.0"?><ASAP_Annotations><Annotations>' + ''.join(annotations) +
+                '</Annotations><AnnotationGroups><Group Name="hotspot" PartOfGroup="None" Color="#64FE2E" />' +
+                ('<Group Name="region" PartOfGroup="None" Color="#64FE2E" />' if regions else '') +
+                '</AnnotationGroups></ASAP_Annotations>')
+
+
+def make_tma_csv(file_path, width, height):
+    # QuPath TMA export of the cores (the radius is slightly larger than the core, so neighbouring cores share tiles)
+    centers, radius = _cores(width, height)
+    rows = ['Image;Name;Class;Parent;ROI;Centroid X (pixels);Centroid Y (pixels);Radius (pixels);Missing core;'
+            'Core Unique ID']
+    for i, (cx, cy) in enumerate(centers):
+        rows.append(f'slide.tif;{chr(65 + i // TMA_GRID[0])}-{i % TMA_GRID[0] + 1};;;Circle;{cx:.1f};{cy:.1f};'
+                    f'{radius * 1.1:.1f};False;{i + 1}')
+    with open(file_path, 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+
+
+def fixtures(sizes: str = 'small', data_path: str = DATA_PATH):
+    """
+    Generates the synthetic slide, ASAP xml and QuPath csv of every size (comma separated, see SIZES) in
+    data_path/<size>, unless they exist already.
+    """
+    for size in _split(sizes):
+        width, height = SIZES[size]
+        folder = os.path.join(data_path, size)
+        os.makedirs(folder, exist_ok=True)
+        slide_path = os.path.join(folder, 'slide.tif')
+        if not os.path.isfile(slide_path):
+            print(f'Generating the {size} slide ({width} x {height} pixels).')
+            make_slide(slide_path, width, height)
+        make_asap_xml(os.path.join(folder, 'slide.xml'), width, height)
+        make_tma_csv(os.path.join(folder, 'slide.csv'), width, height)
+
+
+def _split(names):
+    return list(names) if isinstance(names, (list, tuple)) else [n.strip() for n in str(names).split(',') if n.strip()]
+
+
+def _max_rss():
+    # peak resident set size in bytes of this process and its (finished) worker processes (linux reports kilobytes)
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def _folder_size(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def run_scenario(scenario: str, size: str, data_path: str = DATA_PATH):
+    # runs a single scenario (in its own process, started by run) and prints the time and the peak memory as json
+    from wsi_to_png import extract_whole_slide
+    from asap_to_png import extract_patch
+    from TMA_to_png import extract_tma
+    from manifest import JobManifest
+
+    folder = os.path.join(data_path, size)
+    slide_path = os.path.join(folder, 'slide.tif')
+    function_name, kwargs = SCENARIOS[scenario]
+    output_path = tempfile.mkdtemp(prefix=f'benchmark-{scenario}-')
+    try:
+        if function_name == 'extract_whole_slide':
+            call = lambda: extract_whole_slide(slide_path, output_path, **kwargs)
+        elif function_name == 'extract_patch':
+            call = lambda: extract_patch(slide_path, output_path, os.path.join(folder, 'slide.xml'), **kwargs)
+        else:
+            call = lambda: extract_tma(slide_path, os.path.join(folder, 'slide.csv'), output_path, **kwargs)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            call()
+        duration = time.perf_counter() - start
+        # a scenario that fails (some of) its images is not a valid measurement
+        slides = JobManifest(output_path).slides
+        failed = {key: entry.get('error') for key, entry in slides.items() if entry['status'] != 'done'}
+        if not slides or failed:
+            raise RuntimeError(f'Scenario {scenario} ({size}) failed: {failed if failed else "no slides processed"}')
+        print(json.dumps({'scenario': scenario, 'size': size, 'seconds': duration,
+                          'peak_rss_mb': _max_rss() / 2 ** 20, 'output_mb': _folder_size(output_path) / 2 ** 20}))
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+
+
+def _git(*args):
+    try:
+        return subprocess.run(['git', *args], cwd=REPO_PATH, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes: str = 'small', scenarios: str = None, repeats: int = 3, data_path: str = DATA_PATH,
+        results_path: str = RESULTS_PATH, label: str = None):
+    """
+    Runs the scenarios (comma separated, default is all of SCENARIOS) on the synthetic slides of the sizes (comma
+    separated, see SIZES). Every run is a fresh process, the fastest of the repeats and its peak memory are kept.
+    The results are saved to results_path/<label>.json, the label is the current git commit by default
+    (with '-dirty' if there are uncommitted changes), so they can be compared between commits (see compare).
+    """
+    fixtures(sizes, data_path)
+    commit = _git('rev-parse', '--short', 'HEAD')
+    dirty = bool(_git('status', '--porcelain', '--untracked-files=no'))
+    if label is None:
+        label = f'{commit}-dirty' if dirty else (commit or 'unknown')
+
+    results = {}
+    for size in _split(sizes):
+        for scenario in _split(scenarios) if scenarios else SCENARIOS:
+            runs = []
+            for _ in range(repeats):
+                process = subprocess.run([sys.executable, __file__, 'run_scenario', scenario, size,
+                                          f'--data-path={data_path}'], capture_output=True, text=True)
+                if process.returncode != 0:
+                    raise RuntimeError(f'Scenario {scenario} ({size}) failed:\n{process.stderr.strip()}')
+                runs.append(json.loads(process.stdout.strip().splitlines()[-1]))
+            best = min(runs, key=lambda r: r['seconds'])
+            best['runs'] = [r['seconds'] for r in runs]
+            results[f'{scenario}/{size}'] = best
+            print(f'{scenario:>20} {size:>6}: {best["seconds"]:8.2f} s, peak {best["peak_rss_mb"]:7.0f} MB, '
+                  f'output {best["output_mb"]:7.1f} MB')
+
+    os.makedirs(results_path, exist_ok=True)
+    result_file = os.path.join(results_path, f'{label}.json')
+    with open(result_file, 'w') as f:
+        json.dump({'label': label, 'commit': commit, 'dirty': dirty, 'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                   'repeats': repeats, 'results': results}, f, indent=1)
+    print(f'Results saved to {result_file}.')
+
+
+def compare(base: str, head: str = None, results_path: str = RESULTS_PATH, threshold: float = 0.1):
+    """
+    Compares the results of two runs (labels of the result files, e.g. two commits; head is the most recent result
+    file by default). Scenarios whose time or peak memory grew by more than threshold (relative) are marked.
+    """
+    if head is None:
+        files = sorted((f for f in os.listdir(results_path) if f.endswith('.json')),
+                       key=lambda f: os.path.getmtime(os.path.join(results_path, f)))
+        head = os.path.splitext(files[-1])[0]
+    with open(os.path.join(results_path, f'{base}.json')) as f:
+        base_results = json.load(f)['results']
+    with open(os.path.join(results_path, f'{head}.json')) as f:
+        head_results = json.load(f)['results']
+
+    print(f'{"scenario":>27} {base:>12} {head:>12}   time   memory')
+    for key in sorted(set(base_results) & set(head_results)):
+        b, h = base_results[key], head_results[key]
+        time_ratio, memory_ratio = h['seconds'] / b['seconds'], h['peak_rss_mb'] / b['peak_rss_mb']
+        flag = '  <- regression' if time_ratio > 1 + threshold or memory_ratio > 1 + threshold else ''
+        print(f'{key:>27} {b["seconds"]:11.2f}s {h["seconds"]:11.2f}s  {time_ratio:5.2f}x  {memory_ratio:5.2f}x{flag}')
+
+
+if __name__ == '__main__':
+    fire.Fire({'fixtures': fixtures, 'run': run, 'run_scenario': run_scenario, 'compare': compare})
@@ -0,0 +1,50 @@
+import sys
+import importlib
+
+# subcommand: (module, function, description), only the module of the subcommand that runs is imported
+COMMANDS = {
+    'whole': ('wsi_to_png', 'extract_whole_slide', 'Convert whole slide images (or their thumbnails).'),
+    'asap': ('asap_to_png', 'extract_patch', 'Extract the annotations of ASAP xml files.'),
+    'tma': ('TMA_to_png', 'extract_tma', 'Extract the TMA spots of QuPath csv files.'),
+    'tiles': ('tiles_to_png', 'extract_tiles', 'Cover the tissue of the slides with tiles of a fixed size.'),
+    'worker': ('conversion_worker', 'serve', 'Run a worker that keeps the slides open between jobs.'),
+    'submit': ('conversion_worker', 'submit', 'Send a job to a worker.'),
+    'merge': ('sharding', 'merge_shards', 'Combine the manifests and reports of the shards of a run.'),
+}
+
+
+def usage(name):
+    lines = [f'Usage: {name} <command> [command line arguments]', '', 'Commands:']
+    lines += [f'    {command:<8}{description}' for command, (_, _, description) in COMMANDS.items()]
+    lines += ['', f'Run {name} <command> --help for the arguments of a command.']
+    return '\n'.join(lines)
+
+
+def main(argv=None, name='python cli.py'):
+    """
+    Runs a command: the first argument is the command (the converters whole, asap, tma or tiles, worker and submit
+    of the conversion worker, or merge of the shards of a run), the other arguments are passed to it (the same as for
+    the scripts, e.g. python wsi_to_png.py). The heavy dependencies are imported lazily, so a job only imports what
+    its command needs.
+
+    :param argv: list (optional)
+        command line arguments without the program name (default is sys.argv[1:]).
+    :param name: string (optional)
+        program name shown in the help.
+    """
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage(name))
+        return
+    if argv[0] not in COMMANDS:
+        print(f'Unknown command {argv[0]!r}.\n\n{usage(name)}')
+        sys.exit(2)
+
+    module_name, function_name, _ = COMMANDS[argv[0]]
+    function = getattr(importlib.import_module(module_name), function_name)
+    import fire
+    fire.Fire(function, command=argv[1:], name=argv[0])
+
+
+if __name__ == '__main__':
+    main()
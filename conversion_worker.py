@@ -0,0 +1,320 @@
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import socket
+import importlib
+import threading
+import traceback
+import socketserver
+from collections import OrderedDict
+
+from lazy_imports import import_openslide
+from manifest import file_signature, partial_path
+
+openslide = import_openslide()
+
+# command: (module, extractor class), the same commands as the cli, the job arguments are the ones of the command
+EXTRACTORS = {'whole': ('wsi_to_png', 'PngExtractor'), 'asap': ('asap_to_png', 'AsapPngExtractor'),
+              'tma': ('TMA_to_png', 'TMAPngExtractor'), 'tiles': ('tiles_to_png', 'TilePngExtractor')}
+# sub folders of the spool folder: new jobs, jobs that are processed, and the finished jobs by status
+SPOOL_FOLDERS = ('incoming', 'running', 'done', 'failed', 'status')
+
+
+class SlideHandlePool:
+    """
+    This Object keeps the slides open between jobs, so a slide that is processed again (e.g. the hotspots, then the
+    TMA cores, then the thumbnail) is not opened and indexed again and keeps the tiles in the openslide cache. The
+    least recently used slides are closed when more than max_size are open, and slides that were not used for
+    idle_seconds are closed by evict_idle. A slide whose file changed is opened again.
+
+    :param max_size: int (optional)
+        Maximal number of open slides (default is 8).
+    :param idle_seconds: float (optional)
+        Slides that were not used for this time are closed (default is 300).
+    """
+
+    def __init__(self, max_size: int = 8, idle_seconds: float = 300):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        # slide path: {'handle', 'signature', 'users', 'last_used'}, the least recently used first
+        self._slides = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def acquire(self, wsi_path):
+        # returns an open handle of the slide, call release when it is not used anymore
+        path = os.path.abspath(wsi_path)
+        signature = file_signature(path)
+        with self._lock:
+            entry = self._slides.get(path)
+            if entry is not None and entry['signature'] == signature:
+                self._slides.move_to_end(path)
+                entry['users'] += 1
+                self.hits += 1
+                return entry['handle']
+            if entry is not None and not entry['users']:
+                # the file changed
+                self._close(path)
+        handle = openslide.open_slide(path)
+        with self._lock:
+            self.misses += 1
+            if path not in self._slides:
+                self._slides[path] = {'handle': handle, 'signature': signature, 'users': 1,
+                                      'last_used': time.monotonic()}
+                self._evict(self.max_size)
+                return handle
+        # the changed slide is still used by another job, the new handle is not pooled
+        return handle
+
+    def release(self, handle):
+        with self._lock:
+            for entry in self._slides.values():
+                if entry['handle'] is handle:
+                    entry['users'] -= 1
+                    entry['last_used'] = time.monotonic()
+                    self._evict(self.max_size)
+                    return
+        handle.close()
+
+    def evict_idle(self):
+        # closes the slides that were not used for idle_seconds
+        now = time.monotonic()
+        with self._lock:
+            for path, entry in list(self._slides.items()):
+                if not entry['users'] and now - entry['last_used'] > self.idle_seconds:
+                    self._close(path)
+
+    def close_all(self):
+        with self._lock:
+            for path in list(self._slides):
+                self._close(path)
+
+    def _evict(self, max_size):
+        # closes the least recently used slides that are not in use, until at most max_size are open
+        for path in [path for path, entry in self._slides.items() if not entry['users']]:
+            if len(self._slides) <= max_size:
+                break
+            self._close(path)
+
+    def _close(self, path):
+        self._slides.pop(path)['handle'].close()
+        self.evictions += 1
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'open': len(self._slides), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+class ConversionWorker:
+    """
+    This Object runs the conversion jobs of a long running worker process: the slides stay open in a SlideHandlePool
+    between the jobs. A job is a json object with the command (whole, asap, tma or tiles, as for the cli) and the
+    arguments of the command, e.g. {"command": "asap", "args": {"file_path": ..., "output_path": ...,
+    "xmls_path": ...}}. The status of a job contains the result of every slide.
+
+    :param max_slides: int (optional)
+        Maximal number of open slides (default is 8).
+    :param idle_seconds: float (optional)
+        Slides that were not used for this time are closed (default is 300).
+    """
+
+    def __init__(self, max_slides: int = 8, idle_seconds: float = 300):
+        self.slide_pool = SlideHandlePool(max_size=max_slides, idle_seconds=idle_seconds)
+        self.jobs = 0
+
+    def run_job(self, job):
+        # processes a job (dictionary), returns its status (never raises)
+        job_id = job.get('id') or uuid.uuid4().hex
+        status = {'id': job_id, 'command': job.get('command'), 'status': 'failed', 'error': None, 'slides': {}}
+        start = time.perf_counter()
+        try:
+            if job.get('command') not in EXTRACTORS:
+                raise ValueError(f'Unknown command {job.get("command")!r}, use one of {", ".join(EXTRACTORS)}.')
+            module_name, class_name = EXTRACTORS[job['command']]
+            extractor_class = getattr(importlib.import_module(module_name), class_name)
+            extractor = extractor_class(**job.get('args', {}))
+            if extractor.workers > 1:
+                # the slides are opened in the worker processes
+                print(f'Job {job_id} uses {extractor.workers} workers, its slides are not kept open.')
+            else:
+                extractor.slide_pool = self.slide_pool
+            results = extractor.process_files()
+            if results is None:
+                raise ValueError('The input paths of the job are invalid.')
+            status['slides'] = results
+            failed = [wsi_path for wsi_path, error in results.items() if error]
+            if failed:
+                status['error'] = f'{len(failed)} of {len(results)} slides failed.'
+            else:
+                status['status'] = 'done'
+        except Exception as e:
+            traceback.print_exc()
+            status['error'] = f'{type(e).__name__}: {e}'
+        self.jobs += 1
+        status['seconds'] = time.perf_counter() - start
+        status['slide_pool'] = self.slide_pool.stats
+        return status
+
+    def serve_spool(self, spool_path, poll_seconds=1., once=False):
+        """
+        Processes the job files (*.json) that are put into spool_path/incoming, in the order of their modification
+        time. A job is moved to spool_path/running while it is processed and to spool_path/done or spool_path/failed
+        afterwards, its status is written to spool_path/status/<job>.json. Jobs left in running by a killed worker
+        are processed again.
+
+        :param spool_path: string
+            path to the spool folder (the sub folders are created).
+        :param poll_seconds: float (optional)
+            Time between two checks for new jobs (default is 1).
+        :param once: bool (optional)
+            If True, the worker stops when there are no more jobs (default is False, it runs until it is killed).
+        """
+        for folder in SPOOL_FOLDERS:
+            os.makedirs(os.path.join(spool_path, folder), exist_ok=True)
+        incoming, running = os.path.join(spool_path, 'incoming'), os.path.join(spool_path, 'running')
+        # jobs of a killed worker
+        for file_name in os.listdir(running):
+            os.replace(os.path.join(running, file_name), os.path.join(incoming, file_name))
+
+        print(f'Waiting for jobs in {incoming}.')
+        try:
+            while True:
+                job_files = [entry for entry in os.scandir(incoming)
+                             if entry.name.endswith('.json') and '.partial' not in entry.name]
+                if not job_files:
+                    if once:
+                        break
+                    self.slide_pool.evict_idle()
+                    time.sleep(poll_seconds)
+                    continue
+                job_file = min(job_files, key=lambda entry: (entry.stat().st_mtime, entry.name))
+                running_path = os.path.join(running, job_file.name)
+                try:
+                    # claim the job (another worker may have taken it)
+                    os.replace(job_file.path, running_path)
+                except FileNotFoundError:
+                    continue
+                self._run_job_file(spool_path, running_path)
+        finally:
+            self.slide_pool.close_all()
+
+    def _run_job_file(self, spool_path, running_path):
+        file_name = os.path.basename(running_path)
+        job_id = os.path.splitext(file_name)[0]
+        try:
+            with open(running_path) as f:
+                job = json.load(f)
+            if not isinstance(job, dict):
+                raise TypeError(f'a job is a json object, not {type(job).__name__}')
+            job = {'id': job_id, **job}
+        except (OSError, ValueError, TypeError) as e:
+            status = {'id': job_id, 'status': 'failed', 'error': f'Invalid job file: {e}'}
+        else:
+            print(f'Processing job {job_id}.')
+            self._write_status(spool_path, job_id, {'id': job_id, 'command': job.get('command'), 'status': 'running'})
+            status = self.run_job(job)
+        self._write_status(spool_path, job_id, status)
+        os.replace(running_path, os.path.join(spool_path, status['status'], file_name))
+        print(f'Job {job_id} failed: {status["error"]}' if status['error'] else f'Job {job_id} done.')
+
+    @staticmethod
+    def _write_status(spool_path, job_id, status):
+        status_path = os.path.join(spool_path, 'status', f'{job_id}.json')
+        temp_path = partial_path(status_path)
+        with open(temp_path, 'w') as f:
+            json.dump(status, f, indent=1)
+        os.replace(temp_path, status_path)
+
+    def serve_socket(self, socket_path, poll_seconds=1.):
+        """
+        Processes the jobs sent to a unix socket, one at a time: a client sends a job as one line of json and receives
+        the status of the job as one line of json. {"command": "status"} returns the state of the worker.
+
+        :param socket_path: string
+            path of the unix socket (replaced if it exists).
+        :param poll_seconds: float (optional)
+            Time between two checks for idle slides (default is 1).
+        """
+        worker = self
+
+        class JobHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    job = json.loads(self.rfile.readline())
+                    if not isinstance(job, dict):
+                        raise TypeError(f'a job is a json object, not {type(job).__name__}')
+                except (ValueError, TypeError) as e:
+                    status = {'status': 'failed', 'error': f'Invalid job: {e}'}
+                else:
+                    if job.get('command') == 'status':
+                        status = {'status': 'done', 'jobs': worker.jobs, 'slide_pool': worker.slide_pool.stats}
+                    else:
+                        status = worker.run_job(job)
+                self.wfile.write((json.dumps(status) + '\n').encode())
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = socketserver.UnixStreamServer(socket_path, JobHandler)
+        server.timeout = poll_seconds
+        print(f'Waiting for jobs on {socket_path}.')
+        try:
+            while True:
+                server.handle_request()
+                self.slide_pool.evict_idle()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+            self.slide_pool.close_all()
+
+
+def serve(spool_path: str = None, socket_path: str = None, max_slides: int = 8, idle_seconds: float = 300,
+          poll_seconds: float = 1., once: bool = False):
+    # runs a worker on a spool folder or on a unix socket
+    if bool(spool_path) == bool(socket_path):
+        raise ValueError('Set either spool_path or socket_path.')
+    worker = ConversionWorker(max_slides=max_slides, idle_seconds=idle_seconds)
+    # a killed worker closes its slides (and removes its socket)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if spool_path:
+        worker.serve_spool(spool_path, poll_seconds=poll_seconds, once=once)
+    else:
+        worker.serve_socket(socket_path, poll_seconds=poll_seconds)
+
+
+def submit(command: str, spool_path: str = None, socket_path: str = None, job_id: str = None, **args):
+    # sends a job (command and its arguments) to a worker: to a spool folder (returns the job id, the status is
+    # written to spool_path/status/<job id>.json) or to a unix socket (waits for the job and prints its status)
+    if bool(spool_path) == bool(socket_path):
+        raise ValueError('Set either spool_path or socket_path.')
+    job = {'command': command, 'args': args}
+    if spool_path:
+        job_id = job_id if job_id else f'{time.strftime("%Y%m%d-%H%M%S")}-{uuid.uuid4().hex[:8]}'
+        incoming = os.path.join(spool_path, 'incoming')
+        os.makedirs(incoming, exist_ok=True)
+        job_path = os.path.join(incoming, f'{job_id}.json')
+        temp_path = partial_path(job_path)
+        with open(temp_path, 'w') as f:
+            json.dump(job, f, indent=1)
+        os.replace(temp_path, job_path)
+        print(f'Job {job_id} added to {incoming}.')
+        return job_id
+
+    if job_id:
+        job['id'] = job_id
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(job) + '\n').encode())
+        status = json.loads(client.makefile().readline())
+    print(json.dumps(status, indent=1))
+    if status['status'] != 'done':
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire({'serve': serve, 'submit': submit})
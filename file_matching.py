@@ -0,0 +1,98 @@
+import os
+import re
+import json
+from bisect import bisect_left
+
+MATCH_RULES = ['exact', 'prefix', 'regex']
+MATCH_REPORT_FILE_NAME = 'match_report.json'
+
+
+def normalize_stem(file_path):
+    # file name without folder and extension, lower case
+    return os.path.splitext(os.path.basename(file_path))[0].strip().lower()
+
+
+def match_files(wsi_files, coord_files, match_rule: str = 'prefix', match_pattern: str = None):
+    """
+    Pairs every whole slide image with its coordinate file (e.g. ASAP xml, QuPath csv). The coordinate files are
+    indexed once by their normalized file name (see normalize_stem), so matching is near-linear in the number of files.
+
+    :param wsi_files: list
+        paths to the whole slide images.
+    :param coord_files: list
+        paths to the coordinate files.
+    :param match_rule: string (optional)
+        'exact': the file names (without extension) are equal,
+        'prefix': the coordinate file name starts with the slide file name, followed by the end of the name or a
+        separator, e.g. 'slide1_hotspots.xml' for 'slide1.mrxs', but not 'slide10.xml' (default),
+        'regex': match_pattern is searched in both file names and the matched key has to be equal.
+    :param match_pattern: string (optional)
+        Regular expression for the 'regex' rule. The first group is used as key (or the whole match if there is no
+        group), e.g. '^(patient\\d+)' pairs 'patient12_CD8.mrxs' with 'Patient12_hotspots.xml'.
+    :return: dict
+        report with 'matched' (slide: coordinate file), 'missing' (slides without coordinate file),
+        'ambiguous' (slide: list of coordinate files) and 'unused' (coordinate files without slide).
+    """
+    if match_rule not in MATCH_RULES:
+        raise ValueError(f'Unknown match rule {match_rule}. Choose one of {", ".join(MATCH_RULES)}.')
+    if match_rule == 'regex':
+        if not match_pattern:
+            raise ValueError('The regex match rule needs a match pattern.')
+        pattern = re.compile(match_pattern, re.IGNORECASE)
+
+        def get_key(file_path):
+            match = pattern.search(normalize_stem(file_path))
+            if match is None:
+                return None
+            return (match.group(1) if pattern.groups else match.group(0)).lower()
+    else:
+        get_key = normalize_stem
+
+    # index of the coordinate files
+    index = {}
+    for coord_file in coord_files:
+        key = get_key(coord_file)
+        if key is not None:
+            index.setdefault(key, []).append(coord_file)
+    sorted_keys = sorted(index)
+
+    report = {'matched': {}, 'missing': [], 'ambiguous': {}, 'unused': []}
+    used = set()
+    for wsi_path in wsi_files:
+        key = get_key(wsi_path)
+        if key is None:
+            candidates = []
+        elif match_rule == 'prefix':
+            # all the keys starting with the slide name are next to each other in the sorted keys
+            candidates = []
+            i = bisect_left(sorted_keys, key)
+            while i < len(sorted_keys) and sorted_keys[i].startswith(key):
+                # the name has to continue with a separator (slide1 does not match slide10)
+                if len(sorted_keys[i]) == len(key) or not sorted_keys[i][len(key)].isalnum():
+                    candidates.extend(index[sorted_keys[i]])
+                i += 1
+        else:
+            candidates = index.get(key, [])
+
+        if len(candidates) == 1:
+            report['matched'][wsi_path] = candidates[0]
+        elif candidates:
+            report['ambiguous'][wsi_path] = sorted(candidates)
+        else:
+            report['missing'].append(wsi_path)
+        used.update(candidates)
+    report['unused'] = sorted(set(coord_files) - used)
+
+    return report
+
+
+def save_match_report(report, output_path, file_name=MATCH_REPORT_FILE_NAME, save=True):
+    # writes the report to the output folder (unless save is False, e.g. for a dry run) and prints a summary
+    report_path = os.path.join(output_path, file_name)
+    if save:
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=1)
+    print(f'Matched {len(report["matched"])} slides. {len(report["missing"])} slides without and '
+          f'{len(report["ambiguous"])} slides with several coordinate files are skipped, '
+          f'{len(report["unused"])} coordinate files are not used'
+          f'{f" (see {report_path})" if save else ""}.')
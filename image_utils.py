@@ -0,0 +1,83 @@
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+# number of pixels that are converted at once, limits the size of the temporary buffers
+CHUNK_PIXELS = 2 ** 20
+
+
+def rgba_to_rgb(img, out=None):
+    # converts an RGBA image (PIL image as returned by openslide read_region, or uint8 array) into a contiguous uint8
+    # RGB array, all pixels that are not fully opaque become white (the same as img[img[:, :, 3] != 255] = 255)
+    # the conversion is done in chunks of rows and the alpha channel is dropped while copying, so no full-size RGBA
+    # array or mask is allocated besides the output. A PIL image is first copied into a numpy array (np.asarray is not
+    # a view of a PIL image), pass it as a temporary (e.g. rgba_to_rgb(wsi_img.read_region(...))) so that it can be
+    # freed after the copy, or read large regions in strips (see PngExtractor.read_rgb).
+    rgba = np.ascontiguousarray(img)
+    del img
+    height, width = rgba.shape[:2]
+    if out is None:
+        out = np.empty((height, width, 3), dtype=np.uint8)
+    rows_per_chunk = max(1, CHUNK_PIXELS // max(1, width))
+    for start in range(0, height, rows_per_chunk):
+        block = rgba[start:start + rows_per_chunk]
+        # whole pixels as uint32: 0xFFFFFFFF for the pixels that are not fully opaque, 0 otherwise
+        # (much faster than a masked assignment)
+        pixels = (block[:, :, 3] != 255).view(np.uint8).astype(np.uint32)
+        np.negative(pixels, out=pixels)
+        np.bitwise_or(block.view(np.uint32)[:, :, 0], pixels, out=pixels)
+        np.copyto(out[start:start + rows_per_chunk], pixels.view(np.uint8).reshape(block.shape)[:, :, :3])
+    return out
+
+
+def polygon_mask(vertices, width, height):
+    # rasterizes a polygon (array of (x, y) vertices in pixel coordinates of the image, (0, 0) is the top-left
+    # corner of the top-left pixel) into a boolean (height, width) mask, True for the pixels whose center is inside
+    # (even-odd rule). For every row the crossings with all the edges are computed at once and marked in a toggle
+    # array, whose cumulative sum along the row is odd inside the polygon.
+    vertices = np.asarray(vertices, dtype=np.float64)
+    x0, y0 = vertices[:, 0], vertices[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    mask = np.empty((height, width), dtype=bool)
+    # limit the size of the (rows x edges) temporary arrays
+    rows_per_chunk = max(1, CHUNK_PIXELS // max(1, len(vertices), width))
+    for start in range(0, height, rows_per_chunk):
+        rows = min(rows_per_chunk, height - start)
+        centers = (np.arange(start, start + rows) + 0.5)[:, None]
+        crossing_rows, crossing_edges = np.nonzero((y0 <= centers) != (y1 <= centers))
+        # x position of the crossings (the edges that cross a row are never horizontal)
+        e = crossing_edges
+        xs = x0[e] + (centers[crossing_rows, 0] - y0[e]) * (x1[e] - x0[e]) / (y1[e] - y0[e])
+        # the first pixel whose center is right of the crossing
+        cols = np.clip(np.floor(xs - 0.5) + 1, 0, width).astype(np.int64)
+        toggles = np.zeros((rows, width + 1), dtype=np.uint8)
+        np.add.at(toggles, (crossing_rows, cols), 1)
+        # uint8 overflows keep the parity
+        mask[start:start + rows] = np.cumsum(toggles, axis=1, dtype=np.uint8)[:, :width] & 1
+    return mask
+
+
+def resize_rgb(img, size, box=None):
+    # resizes a uint8 RGB array to size (width, height) with a box filter (the average of the covered pixels, which
+    # is what a lower pyramid level holds), returns a contiguous (writable) uint8 RGB array
+    # box (left, upper, right, lower, may be fractional) is the part of img that is resized (default is all of it)
+    if (img.shape[1], img.shape[0]) == tuple(size) and (box is None or box == (0, 0, img.shape[1], img.shape[0])):
+        return img
+    return np.array(Image.fromarray(img).resize(size, resample=Image.BOX, box=box))
+
+
+def tissue_mask(img, saturation_threshold=20):
+    # boolean mask of the tissue in a uint8 RGB image (e.g. a low resolution level of a slide): the background
+    # (glass, white) is grey, so a pixel is tissue if its saturation (max - min of the channels) exceeds the threshold
+    return (img.max(axis=2) - img.min(axis=2)) > saturation_threshold
+
+
+def box_sums(mask, x0, y0, x1, y1):
+    # number of True pixels of a 2D mask in the boxes [x0, x1) x [y0, y1) (integer arrays of the same shape, clipped
+    # to the mask), computed for all boxes at once with an integral image
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    np.cumsum(np.cumsum(mask, axis=0), axis=1, out=integral[1:, 1:])
+    x0, x1 = np.clip(x0, 0, mask.shape[1]), np.clip(x1, 0, mask.shape[1])
+    y0, y1 = np.clip(y0, 0, mask.shape[0]), np.clip(y1, 0, mask.shape[0])
+    return integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
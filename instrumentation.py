@@ -0,0 +1,152 @@
+import os
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from manifest import partial_path
+
+PROFILE_FILE_NAME = 'profile'
+RECORD_FIELDS = ['slide', 'patch', 'stage', 'seconds', 'pixels', 'bytes']
+
+
+class TimedFile:
+    # wraps a binary file and measures the time spent in (and the bytes passed to) its write calls, so the
+    # encoding and the writing of an image can be told apart
+
+    def __init__(self, file):
+        self._file = file
+        self.seconds = 0.
+        self.bytes = 0
+
+    def write(self, data):
+        start = time.perf_counter()
+        result = self._file.write(data)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class Profiler:
+    """
+    This Object records the wall time, the number of pixels and the number of bytes of every stage (open_slide,
+    read_region, rgba_to_rgb, resize, mask, encode, write, ...) of every patch and slide. The records of the worker
+    processes are collected by the main process. If it is disabled, nothing is recorded and the stages cost nothing.
+
+    :param enabled: bool (optional)
+        Record the stages (default is False).
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        # the slide that is processed by this process
+        self.slide = None
+        self.records = []
+        self._lock = threading.Lock()
+        # the patch that is processed by the current thread
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # locks and thread locals can not be sent to the worker processes
+        state = self.__dict__.copy()
+        del state['_lock'], state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add(self, stage, seconds, pixels=0, nbytes=0, patch=None):
+        if not self.enabled:
+            return
+        record = {'slide': self.slide, 'patch': patch if patch else getattr(self._local, 'patch', None),
+                  'stage': stage, 'seconds': seconds, 'pixels': int(pixels), 'bytes': int(nbytes)}
+        with self._lock:
+            self.records.append(record)
+
+    @contextmanager
+    def stage(self, stage, pixels=0, nbytes=0):
+        # measures the wall time of the with block
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.add(stage, time.perf_counter() - start, pixels, nbytes)
+
+    @contextmanager
+    def patch(self, patch):
+        # the stages in the with block (of this thread) are recorded for the patch
+        previous = getattr(self._local, 'patch', None)
+        self._local.patch = patch
+        try:
+            yield
+        finally:
+            self._local.patch = previous
+
+    @contextmanager
+    def encode(self, file, pixels=0):
+        # measures the encoding of an image to the file: yields the file to write to, the time spent in the write
+        # calls is recorded as write stage and the rest as encode stage
+        if not self.enabled:
+            yield file
+            return
+        timed_file = TimedFile(file)
+        start = time.perf_counter()
+        yield timed_file
+        self.add('encode', time.perf_counter() - start - timed_file.seconds, pixels)
+        self.add('write', timed_file.seconds, nbytes=timed_file.bytes)
+
+    def pop_records(self):
+        # returns and removes the records (e.g. to send them from a worker process to the main process)
+        with self._lock:
+            records, self.records = self.records, []
+        return records
+
+    def merge(self, records):
+        with self._lock:
+            self.records.extend(records)
+
+    def summary(self, wall_seconds, slides):
+        # totals per stage and per slide, throughput of the run
+        stages, per_slide = {}, {}
+        for record in self.records:
+            total = stages.setdefault(record['stage'], {'count': 0, 'seconds': 0., 'pixels': 0, 'bytes': 0})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            total['pixels'] += record['pixels']
+            total['bytes'] += record['bytes']
+            slide = per_slide.setdefault(record['slide'], {})
+            slide[record['stage']] = slide.get(record['stage'], 0.) + record['seconds']
+        # output pixels are counted once per image, by the encode stage
+        megapixels = stages.get('encode', {}).get('pixels', 0) / 1e6
+        return {'wall_seconds': wall_seconds, 'slides': slides,
+                'megapixels_per_second': megapixels / wall_seconds if wall_seconds else 0.,
+                'slides_per_hour': slides / wall_seconds * 3600 if wall_seconds else 0.,
+                'stages': stages, 'per_slide': per_slide}
+
+    def save_report(self, output_path, wall_seconds, slides, file_name=PROFILE_FILE_NAME):
+        # writes the summary and all the records to profile.json and the records to profile.csv, prints the summary
+        summary = self.summary(wall_seconds, slides)
+        json_path = os.path.join(output_path, f'{file_name}.json')
+        temp_path = partial_path(json_path)
+        with open(temp_path, 'w') as f:
+            json.dump({**summary, 'records': self.records}, f, indent=1)
+        os.replace(temp_path, json_path)
+        csv_path = os.path.join(output_path, f'{file_name}.csv')
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
+
+        print(f'Processed {slides} slides in {wall_seconds:.1f} s: {summary["megapixels_per_second"]:.1f} MP/s, '
+              f'{summary["slides_per_hour"]:.0f} slides/hour (see {json_path}).')
+        for stage, total in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+            print(f'    {stage:>12}: {total["seconds"]:8.2f} s in {total["count"]} calls, '
+                  f'{total["pixels"] / 1e6:.1f} MP, {total["bytes"] / 2 ** 20:.1f} MB')
+        return summary
@@ -0,0 +1,45 @@
+import os
+import sys
+import platform
+import importlib.util
+
+# folder of the openslide dll on windows, added to the PATH before openslide is loaded
+OPENSLIDE_WINDOWS_PATH = r'C:\Users\ls19k424\Documents\openslide-win64-20171122\bin'
+
+
+def lazy_import(name: str):
+    """
+    Returns the module without executing it: the module is only loaded when one of its attributes is used for the
+    first time. The heavy dependencies (numpy, PIL, pandas, openslide) are imported this way, so they only add to the
+    startup time of the code paths that actually use them (e.g. pandas only when an excel or csv file is read).
+
+    :param name: string
+        full name of the module (e.g. 'PIL.Image').
+    :return: module
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f'No module named {name!r}', name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def load(*modules):
+    # loads lazy modules now: LazyLoader is not thread safe (before python 3.12), so the modules used by the threads
+    # of a pipeline have to be loaded before the threads start
+    for module in modules:
+        getattr(module, '__name__')
+
+
+def import_openslide():
+    # openslide (lazy), the path to the dll is added to the PATH on windows
+    if platform.system() == 'Windows' and OPENSLIDE_WINDOWS_PATH not in os.environ['PATH']:
+        print('INFO: Path to openslide ddl is manually added to the path.')
+        os.environ['PATH'] = OPENSLIDE_WINDOWS_PATH + ";" + os.environ['PATH']
+    return lazy_import('openslide')
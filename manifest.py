@@ -0,0 +1,98 @@
+import os
+import json
+import time
+from contextlib import contextmanager
+
+MANIFEST_FILE_NAME = 'manifest.json'
+# the manifest is written at most every SAVE_INTERVAL seconds while a batch is running (and always at the end)
+SAVE_INTERVAL = 10
+PNG_TRAILER = b'IEND\xaeB`\x82'
+
+
+def partial_path(file_path):
+    # outputs are written to this path first and renamed when they are complete, so a killed run never leaves an
+    # incomplete file under the final name (the extension is kept, it determines the file format)
+    root, extension = os.path.splitext(file_path)
+    return f'{root}.partial{extension}'
+
+
+@contextmanager
+def partial_file(file_path):
+    # yields the partial path of an output: it is renamed to file_path when the block succeeds, and removed if the
+    # block fails, so a failed image does not leave its incomplete file behind
+    temp_path = partial_path(file_path)
+    try:
+        yield temp_path
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.replace(temp_path, file_path)
+
+
+def is_complete(file_path):
+    # checks an output that is not recorded in the manifest (e.g. written by an older version): png files written
+    # by a killed run are missing their end chunk
+    if not os.path.isfile(file_path) or os.path.getsize(file_path) == 0:
+        return False
+    if file_path.endswith('.png'):
+        with open(file_path, 'rb') as f:
+            f.seek(-len(PNG_TRAILER), os.SEEK_END)
+            return f.read() == PNG_TRAILER
+    return True
+
+
+def file_signature(file_path):
+    # path, size and modification time of an input file
+    stat = os.stat(file_path)
+    signature = {'path': os.path.abspath(file_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    # the image data of mrxs files is in the folder with the same name, Slidedat.ini changes with it
+    slidedat = os.path.join(os.path.splitext(file_path)[0], 'Slidedat.ini')
+    if file_path.endswith('.mrxs') and os.path.isfile(slidedat):
+        signature['slidedat'] = file_signature(slidedat)
+    return signature
+
+
+def json_coord(coord):
+    # coordinates as they are stored in the manifest (nested lists of floats)
+    if coord is None:
+        return None
+    return [[float(v) for v in point] if hasattr(point, '__len__') else float(point) for point in coord]
+
+
+class JobManifest:
+    """
+    This Object records the state of a batch run in a json file in the output folder. For every slide it stores the
+    input files (path, size, modification time), the parameters that change the output (level, tag, format, ...),
+    the status and the status of every patch. A re-run only processes new, changed or failed slides and patches,
+    without checking the output files.
+
+    :param output_path: string
+        path to the output folder.
+    :param file_name: string (optional)
+        name of the manifest file (default is 'manifest.json').
+    """
+
+    def __init__(self, output_path: str, file_name: str = MANIFEST_FILE_NAME):
+        self.file_path = os.path.join(output_path, file_name)
+        self.slides = {}
+        if os.path.isfile(self.file_path):
+            with open(self.file_path) as f:
+                self.slides = json.load(f)['slides']
+        self._last_save = time.time()
+
+    def get(self, key):
+        return self.slides.get(key)
+
+    def update(self, key, entry):
+        self.slides[key] = entry
+        if time.time() - self._last_save > SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        # write to a temporary file first, so the manifest is never left half written
+        temp_path = partial_path(self.file_path)
+        with open(temp_path, 'w') as f:
+            json.dump({'slides': self.slides}, f, indent=1)
+        os.replace(temp_path, self.file_path)
+        self._last_save = time.time()
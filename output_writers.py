@@ -0,0 +1,329 @@
+import struct
+import threading
+import zlib
+from abc import ABC, abstractmethod
+from queue import Queue, Full
+
+from lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+
+OUTPUT_EXTENSIONS = {'png': '.png', 'webp': '.webp', 'jpeg': '.jpg', 'tiff': '.tif', 'npy': '.npy'}
+PIL_FORMATS = {'png': 'PNG', 'webp': 'WEBP', 'jpeg': 'JPEG'}
+TIFF_TILE_SIZE = 256
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# number of filtered bytes that are processed at once when choosing the PNG row filters
+FILTER_BLOCK_BYTES = 2 ** 20
+
+
+def _import_tifffile():
+    # tifffile is only needed for the tiff output
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError('The tiff output format needs the tifffile package (pip install tifffile).')
+    return tifffile
+
+
+class OutputFormat:
+    """
+    This Object encodes and writes the extracted images in the chosen file format.
+
+    :param name: string (optional)
+        File format: 'png', 'webp' (lossless), 'jpeg', 'tiff' (tiled, needs tifffile) or 'npy' (default is 'png').
+    :param compress_level: int (optional)
+        zlib compression level of png and tiff files (0-9, default is 6, as PIL). Lower is faster, higher is smaller.
+    :param quality: int (optional)
+        Quality of jpeg files (1-95, default is 90).
+    """
+
+    def __init__(self, name: str = 'png', compress_level: int = 6, quality: int = 90):
+        if name not in OUTPUT_EXTENSIONS:
+            raise ValueError(f'Unknown output format {name}. Choose one of {", ".join(OUTPUT_EXTENSIONS)}.')
+        self.name = name
+        self.compress_level = compress_level
+        self.quality = quality
+
+    @property
+    def extension(self):
+        return OUTPUT_EXTENSIONS[self.name]
+
+    @property
+    def params(self):
+        # the settings that change the output of this format
+        params = {'format': self.name}
+        if self.name in ['png', 'tiff']:
+            params['compress_level'] = self.compress_level
+        elif self.name == 'jpeg':
+            params['quality'] = self.quality
+        return params
+
+    @property
+    def supports_streaming(self):
+        # jpeg and webp images can only be encoded from the full image
+        return self.name in ['png', 'tiff', 'npy']
+
+    def save(self, img, file_path):
+        # img has to be an uint8 RGB array of shape (height, width, 3), file_path can also be a binary file object
+        if self.name == 'npy':
+            np.save(file_path, img)
+        elif self.name == 'tiff':
+            _import_tifffile().imwrite(file_path, img, photometric='rgb', tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE),
+                                       compression='zlib', compressionargs={'level': self.compress_level})
+        elif self.name == 'png':
+            Image.fromarray(img).save(file_path, format=PIL_FORMATS[self.name], compress_level=self.compress_level)
+        elif self.name == 'webp':
+            Image.fromarray(img).save(file_path, format=PIL_FORMATS[self.name], lossless=True)
+        else:
+            Image.fromarray(img).save(file_path, format=PIL_FORMATS[self.name], quality=self.quality)
+
+    def open_stream(self, file_path, width, height):
+        # returns a writer to which the image can be written block of rows by block of rows
+        if self.name == 'png':
+            return StreamingPngWriter(file_path, width, height, compress_level=self.compress_level)
+        elif self.name == 'tiff':
+            return StreamingTiffWriter(file_path, width, height, compress_level=self.compress_level)
+        elif self.name == 'npy':
+            return StreamingNpyWriter(file_path, width, height)
+        raise ValueError(f'The {self.name} output format can not be written block by block.')
+
+
+class StreamWriter(ABC):
+    # base class of the streaming writers: an image is written with write_rows and finalized with close.
+    # If an error occurs within a with block, the (incomplete) file is not finalized.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @abstractmethod
+    def write_rows(self, rows):
+        # writes the next block of rows (uint8 array of height x width x 3)
+        pass
+
+    @abstractmethod
+    def close(self):
+        # finalizes the file, all the rows must have been written
+        pass
+
+    @abstractmethod
+    def abort(self):
+        # closes the file without finalizing it
+        pass
+
+
+class StreamingPngWriter(StreamWriter):
+    """
+    This Object writes an 8-bit RGB png file block of rows by block of rows, so the full image never has to be
+    held in memory (only the rows that are currently written).
+
+    :param file_path: string
+        path of the png file that is written.
+    :param width: int
+        width of the image in pixels.
+    :param height: int
+        height of the image in pixels.
+    :param compress_level: int (optional)
+        zlib compression level (0-9, default is 6, the same as PIL).
+    """
+
+    def __init__(self, file_path: str, width: int, height: int, compress_level: int = 6):
+        self.file_path = file_path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        # the last row of the previous block is needed for the up, average and paeth filters
+        self._previous_row = np.zeros((1, width * 3), dtype=np.uint8)
+        self._compressor = zlib.compressobj(compress_level)
+        self._file = open(file_path, 'wb')
+        self._file.write(PNG_SIGNATURE)
+        # 8 bit depth, colour type 2 (RGB), default compression, filter method and no interlacing
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack('>I', len(data)))
+        self._file.write(chunk_type)
+        self._file.write(data)
+        self._file.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xffffffff))
+
+    def write_rows(self, rows):
+        # rows has to be an uint8 array of shape (n_rows, width, 3)
+        assert rows.shape[1:] == (self.width, 3) and rows.dtype == np.uint8
+        assert self.rows_written + rows.shape[0] <= self.height
+        rows = rows.reshape(rows.shape[0], self.width * 3)
+        block_rows = max(1, FILTER_BLOCK_BYTES // (self.width * 3))
+        for start in range(0, rows.shape[0], block_rows):
+            block = rows[start:start + block_rows]
+            data = self._compressor.compress(self._filter_rows(block))
+            if data:
+                self._write_chunk(b'IDAT', data)
+            self._previous_row = block[-1:]
+        self.rows_written += rows.shape[0]
+
+    def _filter_rows(self, block):
+        # applies the adaptive png filtering: every row gets the filter (none, sub, up, average, paeth)
+        # with the smallest sum of absolute (signed) differences, like libpng and PIL do
+        x = block.astype(np.int16)
+        up = np.concatenate([self._previous_row, block[:-1]]).astype(np.int16)
+        left = np.zeros_like(x)
+        left[:, 3:] = x[:, :-3]
+        up_left = np.zeros_like(x)
+        up_left[:, 3:] = up[:, :-3]
+
+        # paeth predictor
+        p = left + up - up_left
+        pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - up_left)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+        del p, pa, pb, pc
+
+        candidates = np.stack([x, x - left, x - up, x - (left + up) // 2, x - paeth]).astype(np.uint8)
+        del x, up, left, up_left, paeth
+        # interpret the filtered bytes as signed values to estimate how well they will compress
+        costs = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        filter_types = np.argmin(costs, axis=0)
+
+        filtered = np.empty((block.shape[0], block.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = filter_types
+        filtered[:, 1:] = candidates[filter_types, np.arange(block.shape[0])]
+        return filtered
+
+    def close(self):
+        if self.rows_written != self.height:
+            self._file.close()
+            raise ValueError(f'Only {self.rows_written} of {self.height} rows were written to {self.file_path}.')
+        data = self._compressor.flush()
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self._write_chunk(b'IEND', b'')
+        self._file.close()
+
+    def abort(self):
+        self._file.close()
+
+
+class StreamingNpyWriter(StreamWriter):
+    """
+    This Object writes an uint8 RGB image block of rows by block of rows to a memory mapped .npy file.
+
+    :param file_path: string
+        path of the npy file that is written.
+    :param width: int
+        width of the image in pixels.
+    :param height: int
+        height of the image in pixels.
+    """
+
+    def __init__(self, file_path: str, width: int, height: int):
+        self.file_path = file_path
+        self.height = height
+        self.rows_written = 0
+        self._array = np.lib.format.open_memmap(file_path, mode='w+', dtype=np.uint8, shape=(height, width, 3))
+
+    def write_rows(self, rows):
+        self._array[self.rows_written:self.rows_written + rows.shape[0]] = rows
+        self.rows_written += rows.shape[0]
+
+    def close(self):
+        self._array.flush()
+        self._array = None
+        if self.rows_written != self.height:
+            raise ValueError(f'Only {self.rows_written} of {self.height} rows were written to {self.file_path}.')
+
+    def abort(self):
+        self._array = None
+
+
+class StreamingTiffWriter(StreamWriter):
+    """
+    This Object writes an uint8 RGB image block of rows by block of rows to a tiled tiff file (needs tifffile).
+    tifffile pulls the tiles from a generator, so it runs in its own thread and is fed through a small queue.
+
+    :param file_path: string
+        path of the tiff file that is written.
+    :param width: int
+        width of the image in pixels.
+    :param height: int
+        height of the image in pixels.
+    :param compress_level: int (optional)
+        zlib compression level (0-9, default is 6).
+    """
+
+    def __init__(self, file_path: str, width: int, height: int, compress_level: int = 6):
+        self.file_path = file_path
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        # rows that do not fill a complete row of tiles yet
+        self._pending = np.empty((0, width, 3), dtype=np.uint8)
+        self._queue = Queue(maxsize=-(-width // TIFF_TILE_SIZE))
+        self._error = None
+        tifffile = _import_tifffile()
+        self._thread = threading.Thread(target=self._write, args=(tifffile, compress_level), daemon=True)
+        self._thread.start()
+
+    def _tiles(self):
+        while True:
+            tile = self._queue.get()
+            if tile is None:
+                return
+            yield tile
+
+    def _write(self, tifffile, compress_level):
+        try:
+            tifffile.imwrite(self.file_path, data=self._tiles(), shape=(self.height, self.width, 3), dtype=np.uint8,
+                             photometric='rgb', tile=(TIFF_TILE_SIZE, TIFF_TILE_SIZE), compression='zlib',
+                             compressionargs={'level': compress_level})
+        except Exception as e:
+            self._error = e
+
+    def _put(self, item):
+        # do not block forever if the writing thread stopped because of an error
+        while True:
+            if self._error is not None:
+                raise self._error
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except Full:
+                if not self._thread.is_alive():
+                    raise RuntimeError(f'Writing {self.file_path} stopped unexpectedly.')
+
+    def _put_tile_row(self, rows):
+        # splits a row of tiles (at most TIFF_TILE_SIZE rows high) into tiles, padded to the full tile size
+        for x in range(0, self.width, TIFF_TILE_SIZE):
+            tile = np.zeros((TIFF_TILE_SIZE, TIFF_TILE_SIZE, 3), dtype=np.uint8)
+            block = rows[:, x:x + TIFF_TILE_SIZE]
+            tile[:block.shape[0], :block.shape[1]] = block
+            self._put(tile)
+
+    def write_rows(self, rows):
+        self.rows_written += rows.shape[0]
+        self._pending = np.concatenate([self._pending, rows])
+        while self._pending.shape[0] >= TIFF_TILE_SIZE:
+            self._put_tile_row(self._pending[:TIFF_TILE_SIZE])
+            self._pending = self._pending[TIFF_TILE_SIZE:]
+
+    def close(self):
+        if self.rows_written != self.height:
+            self.abort()
+            raise ValueError(f'Only {self.rows_written} of {self.height} rows were written to {self.file_path}.')
+        if self._pending.shape[0]:
+            self._put_tile_row(self._pending)
+        self._put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def abort(self):
+        # stops the writing thread, tifffile raises an error because tiles are missing
+        try:
+            self._put(None)
+        except Exception:
+            pass
+        self._thread.join()
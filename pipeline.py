@@ -0,0 +1,71 @@
+import threading
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+# marks the end of the queue for the encoder threads
+_STOP = object()
+
+
+class PatchPipeline:
+    """
+    This Object runs the read and the encode/write stage of the patch extraction concurrently: a pool of reader
+    threads puts the extracted images into a bounded queue, from which a pool of encoder threads saves them.
+    The bounded queue limits the number of images that are held in memory at the same time.
+
+    :param read_workers: int (optional)
+        Number of threads that read the regions from the slide (default is 1).
+    :param encode_workers: int (optional)
+        Number of threads that encode and write the images (default is 1).
+    :param queue_size: int (optional)
+        Maximal number of read images that wait to be encoded (default is twice the number of encoders).
+    """
+
+    def __init__(self, read_workers: int = 1, encode_workers: int = 1, queue_size: int = None):
+        self.read_workers = read_workers
+        self.encode_workers = encode_workers
+        self.queue_size = queue_size if queue_size else 2 * encode_workers
+
+    @property
+    def max_images(self):
+        # maximal number of images that are held at the same time: being read, waiting in the queue (a reader that
+        # waits for a free place still holds its image) and being encoded
+        return self.read_workers + self.queue_size + self.encode_workers
+
+    def run(self, jobs, read_fn, write_fn):
+        # read_fn(job) returns a list of tuples with the arguments of write_fn (empty if there is nothing left to
+        # write, e.g. the image was already streamed to the file; several if one read yields several images).
+        # The first error of any stage is re-raised.
+        queue = Queue(maxsize=self.queue_size)
+        errors = []
+
+        def encode():
+            while True:
+                item = queue.get()
+                if item is _STOP:
+                    break
+                try:
+                    write_fn(*item)
+                except Exception as e:
+                    errors.append(e)
+
+        def read(job):
+            for item in read_fn(job):
+                # blocks if the encoders are behind
+                queue.put(item)
+
+        encoders = [threading.Thread(target=encode, daemon=True) for _ in range(self.encode_workers)]
+        for encoder in encoders:
+            encoder.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+                futures = [executor.submit(read, job) for job in jobs]
+                for future in futures:
+                    future.result()
+        finally:
+            for _ in encoders:
+                queue.put(_STOP)
+            for encoder in encoders:
+                encoder.join()
+
+        if errors:
+            raise errors[0]
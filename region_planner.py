@@ -0,0 +1,94 @@
+DEFAULT_TILE_SIZE = 256
+# openslide decodes the tiles into 32 bit ARGB pixels
+TILE_BYTES_PER_PIXEL = 4
+# peak bytes per pixel of a region that is read at once: the RGBA image returned by read_region, its numpy copy (and
+# the temporary bytes of the copy) and the RGB output, measured with benchmarks/read_memory.py (12.7, rounded up)
+READ_BYTES_PER_PIXEL = 13
+# bytes per pixel of the RGB images that are held after the read
+RGB_BYTES_PER_PIXEL = 3
+# the decoded tiles that openslide caches (its default cache size), once per process
+OPENSLIDE_CACHE_BYTES = 32 * 2 ** 20
+
+
+def get_tile_size(wsi_img, level):
+    # size (width, height) of the tiles the level is stored in, as reported by openslide (not every format does)
+    width = wsi_img.properties.get(f'openslide.level[{level}].tile-width')
+    height = wsi_img.properties.get(f'openslide.level[{level}].tile-height')
+    if width and height:
+        return int(width), int(height)
+    return DEFAULT_TILE_SIZE, DEFAULT_TILE_SIZE
+
+
+def count_tiles(box, tile_size):
+    # number of tiles of the level that have to be decoded to read the box (x0, y0, x1, y1)
+    x0, y0, x1, y1 = box
+    if x1 <= x0 or y1 <= y0:
+        return 0
+    return (((x1 - 1) // tile_size[0] - x0 // tile_size[0] + 1) *
+            ((y1 - 1) // tile_size[1] - y0 // tile_size[1] + 1))
+
+
+def union_box(box, other):
+    return min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])
+
+
+def box_pixels(box):
+    return (box[2] - box[0]) * (box[3] - box[1])
+
+
+def plan_regions(boxes, tile_size, max_pixels):
+    """
+    Groups regions that share tiles of the slide into combined reads, so every tile is decoded once instead of once
+    per region (e.g. neighbouring TMA cores or overlapping annotations). The regions are visited from top to bottom
+    and each is added to the group whose combined read grows the least, if the combined read decodes fewer tiles
+    than the two separate reads and the combined read and its regions (which are copied out of it and held at the
+    same time) do not exceed max_pixels together.
+
+    :param boxes: list
+        regions (x0, y0, x1, y1) in integer pixels of the level that is read.
+    :param tile_size: tuple
+        (width, height) of the tiles of the level (see get_tile_size).
+    :param max_pixels: int
+        maximal number of pixels of a combined read and its regions together (limits the memory).
+    :return: list
+        groups of indices of boxes, every group is read at once.
+    """
+    order = sorted(range(len(boxes)), key=lambda i: (boxes[i][1], boxes[i][0]))
+    # [bounding box, number of tiles, indices, pixels of the regions] of every group
+    groups = []
+    for i in order:
+        box = tuple(boxes[i])
+        tiles = count_tiles(box, tile_size)
+        best, best_tiles = None, None
+        for group in groups:
+            union = union_box(group[0], box)
+            if box_pixels(union) + group[3] + box_pixels(box) > max_pixels:
+                continue
+            union_tiles = count_tiles(union, tile_size)
+            if union_tiles >= group[1] + tiles:
+                continue
+            # the group that needs the fewest additional tiles
+            if best is None or union_tiles - group[1] < best_tiles - best[1]:
+                best, best_tiles = group, union_tiles
+        if best is None:
+            groups.append([box, tiles, [i], box_pixels(box)])
+        else:
+            best[0] = union_box(best[0], box)
+            best[1] = best_tiles
+            best[2].append(i)
+            best[3] += box_pixels(box)
+    return [group[2] for group in groups]
+
+
+def coalescing_report(boxes, groups, tile_size):
+    # number of decoded tiles (and bytes) with one read per region and with one read per group
+    tiles = sum(count_tiles(tuple(box), tile_size) for box in boxes)
+    coalesced_tiles = 0
+    for group in groups:
+        box = tuple(boxes[group[0]])
+        for i in group[1:]:
+            box = union_box(box, tuple(boxes[i]))
+        coalesced_tiles += count_tiles(box, tile_size)
+    tile_bytes = tile_size[0] * tile_size[1] * TILE_BYTES_PER_PIXEL
+    return {'regions': len(boxes), 'reads': len(groups), 'tiles': tiles, 'coalesced_tiles': coalesced_tiles,
+            'saved_bytes': (tiles - coalesced_tiles) * tile_bytes}
@@ -0,0 +1,144 @@
+import os
+import re
+import json
+import hashlib
+
+from file_matching import MATCH_REPORT_FILE_NAME, save_match_report
+from instrumentation import PROFILE_FILE_NAME, Profiler
+from manifest import MANIFEST_FILE_NAME, JobManifest
+
+SHARD_STRATEGIES = ('hash', 'cost')
+# e.g. manifest.shard-2-of-4.json
+SHARD_FILE_PATTERN = re.compile(r'^(?P<root>.+)\.shard-(?P<index>\d+)-of-(?P<count>\d+)(?P<extension>\.\w+)$')
+
+
+def shard_file_name(file_name, shard_index=None, shard_count=None):
+    # name of a file that every shard writes to the output folder (manifest, match report, profile), so the shards
+    # of a run do not overwrite each other, e.g. manifest.json -> manifest.shard-2-of-4.json
+    if shard_count is None:
+        return file_name
+    root, extension = os.path.splitext(file_name)
+    return f'{root}.shard-{shard_index}-of-{shard_count}{extension}'
+
+
+def stable_hash(key):
+    # the same in every process and on every node (unlike hash, which is randomized per process)
+    return int(hashlib.sha1(key.encode()).hexdigest()[:16], 16)
+
+
+def assign_shards(keys, shard_count, costs=None):
+    """
+    Assigns every key (slide) to one of shard_count shards, the same way on every node and independent of the order
+    of the keys. Without costs, the shard is a stable hash of the key: the shards only have the same number of slides
+    on average. With costs, the slides are assigned by decreasing cost, each to the shard with the lowest total cost
+    so far (longest processing time first), which balances the shards but needs the costs of all the slides.
+
+    :param keys: list
+        keys of the slides (strings that are the same on every node, e.g. the path relative to the input folder).
+    :param shard_count: int
+        number of shards.
+    :param costs: dict (optional)
+        estimated cost of every key (default is None, the keys are assigned by hash).
+    :return: dict
+        shard index of every key.
+    """
+    if costs is None:
+        return {key: stable_hash(key) % shard_count for key in keys}
+    totals = [0] * shard_count
+    shards = {}
+    for key in sorted(keys, key=lambda key: (-costs[key], key)):
+        shard = min(range(shard_count), key=lambda i: (totals[i], i))
+        shards[key] = shard
+        totals[shard] += costs[key]
+    return shards
+
+
+def find_shard_files(output_path, file_name):
+    # {shard index: path} of the shard files of file_name in the output folder, and the shard counts found
+    root, extension = os.path.splitext(file_name)
+    shard_files, counts = {}, set()
+    for name in sorted(os.listdir(output_path)):
+        match = SHARD_FILE_PATTERN.match(name)
+        if match and match['root'] == root and match['extension'] == extension:
+            shard_files[int(match['index'])] = os.path.join(output_path, name)
+            counts.add(int(match['count']))
+    return shard_files, counts
+
+
+def _load(file_path):
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def merge_shards(output_path: str):
+    """
+    Combines the manifests, match reports and profiles that the shards of a run (--shard-index, --shard-count) wrote
+    to the output folder into manifest.json, match_report.json and profile.json / profile.csv, as if the run had not
+    been sharded (later runs without sharding skip the processed slides). The shard files are kept, so merging again
+    gives the same result. Prints the number of slides and the time of every shard.
+
+    :param output_path: string
+        path to the output folder of the shards.
+    """
+    manifests, counts = find_shard_files(output_path, MANIFEST_FILE_NAME)
+    if not manifests:
+        print(f'No shard manifests found in {output_path}.')
+        return
+    if len(counts) > 1:
+        print(f'WARNING: The output folder contains shards of runs with {", ".join(map(str, sorted(counts)))} shards.')
+    missing = [i for i in range(max(counts)) if i not in manifests]
+    if missing:
+        print(f'WARNING: The manifests of the shards {", ".join(map(str, missing))} are missing.')
+
+    # manifests: the entries of the shards replace the ones of earlier runs, a successful entry wins over a failed
+    # one of another shard
+    manifest = JobManifest(output_path)
+    merged = {}
+    shard_slides = {}
+    for index, file_path in sorted(manifests.items()):
+        slides = _load(file_path)['slides']
+        shard_slides[index] = slides
+        for key, entry in slides.items():
+            if key not in merged or entry['status'] == 'done' or merged[key]['status'] != 'done':
+                merged[key] = entry
+    manifest.slides.update(merged)
+    manifest.save()
+    print(f'Merged {len(manifests)} shard manifests into {manifest.file_path} ({len(merged)} slides).')
+
+    # match reports: every shard matched all the files, only the slides it processed differ
+    reports, _ = find_shard_files(output_path, MATCH_REPORT_FILE_NAME)
+    if reports:
+        report = {}
+        for _, file_path in sorted(reports.items()):
+            for key, value in _load(file_path).items():
+                if isinstance(value, dict):
+                    report.setdefault(key, {}).update(value)
+                else:
+                    values = report.setdefault(key, [])
+                    values.extend(v for v in value if v not in values)
+        save_match_report(report, output_path)
+
+    # profiles: the shards ran in parallel, the wall time of the run is the one of the slowest shard
+    profiles, _ = find_shard_files(output_path, f'{PROFILE_FILE_NAME}.json')
+    seconds = {}
+    if profiles:
+        profiler = Profiler(enabled=True)
+        slides = 0
+        for index, file_path in sorted(profiles.items()):
+            profile = _load(file_path)
+            profiler.merge(profile['records'])
+            seconds[index] = profile['wall_seconds']
+            slides += profile['slides']
+        profiler.save_report(output_path, max(seconds.values()), slides)
+
+    for index, slides in sorted(shard_slides.items()):
+        failed = sum(entry['status'] != 'done' for entry in slides.values())
+        time_info = f', {seconds[index]:.1f} s' if index in seconds else ''
+        print(f'    shard {index}: {len(slides)} slides ({failed} failed){time_info}')
+    if len(seconds) > 1 and sum(seconds.values()) > 0:
+        print(f'Slowest shard / mean: {max(seconds.values()) / (sum(seconds.values()) / len(seconds)):.2f}')
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(merge_shards)
@@ -0,0 +1,44 @@
+import os
+import json
+import shutil
+import hashlib
+
+from manifest import file_signature, partial_path
+
+
+class ThumbnailCache:
+    """
+    This Object stores extracted thumbnails in a folder, keyed by the slide (path, size and modification time) and
+    the thumbnail parameters. Runs with other output folders (or with overwrite) copy the cached thumbnail of an
+    unchanged slide instead of reading the slide again, only new or changed slides are read.
+
+    :param cache_path: string
+        path to the cache folder (created if it does not exist).
+    """
+
+    def __init__(self, cache_path: str):
+        if not os.path.isdir(cache_path):
+            os.makedirs(cache_path)
+        self.cache_path = cache_path
+
+    def get_path(self, wsi_path, params, extension):
+        # file of the thumbnail in the cache, the name is a hash of the slide signature and the parameters
+        key = json.dumps({'slide': file_signature(wsi_path), 'params': params}, sort_keys=True)
+        return os.path.join(self.cache_path, f'{hashlib.sha1(key.encode()).hexdigest()}{extension}')
+
+    def load(self, wsi_path, params, output_file_path):
+        # copies the cached thumbnail to output_file_path, returns False if the slide is not in the cache
+        cached_path = self.get_path(wsi_path, params, os.path.splitext(output_file_path)[1])
+        if not os.path.isfile(cached_path):
+            return False
+        temp_path = partial_path(output_file_path)
+        shutil.copyfile(cached_path, temp_path)
+        os.replace(temp_path, output_file_path)
+        return True
+
+    def store(self, wsi_path, params, output_file_path):
+        # adds the thumbnail saved at output_file_path to the cache
+        cached_path = self.get_path(wsi_path, params, os.path.splitext(output_file_path)[1])
+        temp_path = partial_path(cached_path)
+        shutil.copyfile(output_file_path, temp_path)
+        os.replace(temp_path, cached_path)
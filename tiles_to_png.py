@@ -0,0 +1,240 @@
+import os
+
+from asap_to_png import AsapPngExtractor
+from image_utils import box_sums, polygon_mask, resize_rgb, tissue_mask
+from lazy_imports import lazy_import
+from region_planner import READ_BYTES_PER_PIXEL
+from wsi_to_png import READ_STRIP_PIXELS
+
+np = lazy_import('numpy')
+
+# maximal number of pixels of the tissue mask: larger tissue levels are reduced while they are read
+TISSUE_MASK_PIXELS = 2 ** 22
+# bytes per pixel of the tissue mask while the tiles are counted: the mask and the int64 integral image (and its
+# int64 cumulative sum) of box_sums
+TISSUE_MASK_BYTES_PER_PIXEL = 17
+
+
+class TilePngExtractor(AsapPngExtractor):
+    """
+    This Object covers a whole slide (or the annotations of an ASAP xml file) with tiles of a fixed size and saves
+    the tiles that contain tissue, e.g. to build a training dataset. The tissue is detected on a low resolution
+    level, so the background tiles are skipped before anything is read at the resolution of the tiles.
+
+    :param file_path: string
+        path to the mrxs single file or folder of files.
+    :param output_path: string
+        path to the output folder. The tiles of a slide are saved in a folder with the name of the mrxs file,
+        the file names of the tiles contain the position of their top-left corner (level 0 pixels).
+    :param xmls_path: string (optional)
+        Path to the coordinate xml files (created with ASAP) single file or folder of files. If provided, only the
+        tiles whose center is inside an annotation with the coord_annotation_tag are saved.
+    :param patch_size: int (optional)
+        Width and height of the tiles in pixels of the level (or target resolution) (default is 512).
+    :param stride: int (optional)
+        Distance between two tiles in pixels of the level (default is patch_size, the tiles do not overlap).
+    :param tissue_threshold: float (optional)
+        Minimal fraction of tissue (in the tile, or in the part of it that is inside the annotation) of a saved tile
+        (default is 0.5, 0 saves all the tiles).
+    :param saturation_threshold: int (optional)
+        Pixels whose saturation (max - min of the RGB values) is above this value are tissue (default is 20).
+    :param tissue_level: int (optional)
+        Level on which the tissue is detected (default is None, the lowest resolution level on which a tile still
+        covers at least 4 x 4 pixels).
+    :param kwargs:
+        Further optional parameters of the AsapPngExtractor and the PngExtractor (e.g. staining, level, target_mpp,
+        coord_annotation_tag, match_rule, workers, patch_workers, encode_workers, output_format).
+    """
+
+    def __init__(self, file_path: str, output_path: str, xmls_path: str = None, patch_size: int = 512,
+                 stride: int = None, tissue_threshold: float = 0.5, saturation_threshold: int = 20,
+                 tissue_level: int = None, **kwargs):
+        # initiate properties from parent class (the tiles are never masked with the annotations)
+        super().__init__(file_path=file_path, output_path=output_path, xmls_path=xmls_path, polygon=False, **kwargs)
+        # instantiate class parameters
+        self.patch_size = patch_size
+        self.stride = stride if stride else patch_size
+        self.tissue_threshold = tissue_threshold
+        self.saturation_threshold = saturation_threshold
+        self.tissue_level = tissue_level
+
+    # overwrite
+    @property
+    def job_params(self):
+        return {**super().job_params, 'patch_size': self.patch_size, 'stride': self.stride,
+                'tissue_threshold': self.tissue_threshold, 'saturation_threshold': self.saturation_threshold}
+
+    # overwrite
+    @property
+    def files_to_process(self):
+        # with annotations, the slides are paired with the xml files the same way as for the patches
+        if self.xmls_path:
+            return super().files_to_process
+
+        files_to_process = []
+        for wsi_path in self.select_shard(self.wsi_files):
+            filename = os.path.splitext(os.path.basename(wsi_path))[0]
+            output_file_name = os.path.join(self.output_path, f'{filename}-{self.resolution_name}-tiles')
+            # skip existing files, if overwrite = False
+            if self.is_processed((output_file_name, wsi_path)):
+                print(f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
+                continue
+            files_to_process.append((output_file_name, wsi_path))
+        return files_to_process
+
+    # overwrite
+    def process_files(self):
+        if self.xmls_path:
+            return super().process_files()
+        elif os.path.isfile(self.file_path) or os.path.isdir(self.file_path):
+            return self.process_batch(self.files_to_process)
+        else:
+            # Something went wrong
+            print('mrxs paths are invalid.')
+
+    # overwrite
+    def process_file(self, output_folder, wsi_path, coord_path=None, previous=None):
+        assert os.path.isfile(wsi_path)
+        if not os.path.isdir(output_folder):
+            os.makedirs(output_folder)
+        wsi_img = self.open_slide(wsi_path)
+        try:
+            return self.process_patches(wsi_img, self.get_patch_jobs(wsi_img, output_folder, coord_path), previous)
+        finally:
+            self.close_slide(wsi_img)
+
+    def get_tissue_level(self, wsi_img, tile_extent):
+        # the lowest resolution level on which a tile (tile_extent level 0 pixels) covers at least 4 x 4 pixels
+        if self.tissue_level is not None:
+            return self.tissue_level
+        levels = [i for i, d in enumerate(wsi_img.level_downsamples) if d <= tile_extent / 4]
+        return levels[-1] if levels else 0
+
+    def read_tissue_mask(self, wsi_img, tissue_level):
+        # reads the tissue level in strips (so it is never held at once, e.g. level 0 of a single level slide) and
+        # finds the tissue in every strip. Strips of levels with more than TISSUE_MASK_PIXELS pixels (or whose mask
+        # needs more than half of the memory budget) are first reduced by a power of 2 (box filter), the other half of
+        # the budget is left for the strip that is being read.
+        # returns the mask and its downsample (level 0 pixels per pixel of the mask)
+        width, height = wsi_img.level_dimensions[tissue_level]
+        downsample = wsi_img.level_downsamples[tissue_level]
+        max_pixels, strip_pixels = TISSUE_MASK_PIXELS, READ_STRIP_PIXELS
+        budget = self.memory_budget
+        if budget is not None:
+            max_pixels = min(max_pixels, int(budget / 2 / TISSUE_MASK_BYTES_PER_PIXEL))
+            strip_pixels = min(strip_pixels, int(budget / 2 / READ_BYTES_PER_PIXEL))
+        factor = 1
+        while factor < max(width, height) and (width // factor) * (height // factor) > max_pixels:
+            factor *= 2
+        mask_width, mask_height = max(1, width // factor), max(1, height // factor)
+        # rows of the level per strip, a multiple of the factor
+        rows = factor * max(1, strip_pixels // (mask_width * factor * factor))
+        mask = np.empty((mask_height, mask_width), dtype=bool)
+        for y in range(0, mask_height * factor, rows):
+            strip_rows = min(rows, mask_height * factor - y)
+            img = self.read_rgb(wsi_img, (0, int(round(y * downsample))), tissue_level,
+                                (mask_width * factor, strip_rows))
+            img = resize_rgb(img, (mask_width, strip_rows // factor))
+            mask[y // factor:(y + strip_rows) // factor] = tissue_mask(img, self.saturation_threshold)
+        return mask, downsample * factor
+
+    # overwrite
+    def get_region(self, wsi_img, coord=None):
+        # the size of a tile on the level is computed from patch_size, not from its corners: they are level 0 pixels
+        # (patch_size x downsample), which are truncated to one pixel less on levels whose downsample is not an integer
+        top_left_coord, id_level, _ = super().get_region(wsi_img, coord)
+        size = max(1, int(round(self.patch_size * self.get_target_downsample(wsi_img) /
+                                wsi_img.level_downsamples[id_level])))
+        return top_left_coord, id_level, (size, size)
+
+    # overwrite
+    def get_patch_jobs(self, wsi_img, output_folder, coord_path=None):
+        # returns a list of (output file path, coordinates) of the tiles that contain tissue
+        downsample = self.get_target_downsample(wsi_img)
+        # size of and distance between the tiles in level 0 pixels
+        extent, step = self.patch_size * downsample, self.stride * downsample
+
+        # find the tissue on the (low resolution) tissue level
+        mask, tissue_downsample = self.read_tissue_mask(wsi_img, self.get_tissue_level(wsi_img, extent))
+        height, width = mask.shape
+
+        if coord_path:
+            # only the tissue inside the annotations (dots are ignored)
+            annotations = [coord for coord in self.parse_xml(coord_path) if coord.ndim == 2 and len(coord) > 2]
+            if not annotations:
+                print(f'No annotations with the tag {self.coord_annotation_tag} found in {coord_path}.')
+                return []
+            region = np.zeros((height, width), dtype=bool)
+            for coord in annotations:
+                region |= polygon_mask(coord / tissue_downsample, width, height)
+            mask &= region
+            points = np.concatenate(annotations)
+            (min_x, min_y), (max_x, max_y) = points.min(axis=0), points.max(axis=0)
+        else:
+            region = None
+            (min_x, min_y), (max_x, max_y) = (0, 0), wsi_img.dimensions
+
+        # top-left corners of the tiles (level 0 pixels): the tiles cover the annotations, or are fully inside the slide
+        if region is not None:
+            xs = min_x + np.arange(int(np.ceil(max(0, max_x - min_x - extent) / step)) + 1) * step
+            ys = min_y + np.arange(int(np.ceil(max(0, max_y - min_y - extent) / step)) + 1) * step
+        else:
+            xs = min_x + np.arange(max(0, int((max_x - min_x - extent) // step) + 1)) * step
+            ys = min_y + np.arange(max(0, int((max_y - min_y - extent) // step) + 1)) * step
+        xs, ys = np.meshgrid(np.round(xs).astype(np.int64), np.round(ys).astype(np.int64))
+        xs, ys = xs.ravel(), ys.ravel()
+
+        # fraction of tissue of every tile on the tissue level
+        x0, y0 = (xs / tissue_downsample).astype(np.int64), (ys / tissue_downsample).astype(np.int64)
+        x1 = np.ceil((xs + extent) / tissue_downsample).astype(np.int64)
+        y1 = np.ceil((ys + extent) / tissue_downsample).astype(np.int64)
+        tissue = box_sums(mask, x0, y0, x1, y1)
+        # with annotations, the fraction of the part of the tile inside of them
+        area = box_sums(region, x0, y0, x1, y1) if region is not None else (x1 - x0) * (y1 - y0)
+        fraction = tissue / np.maximum(area, 1)
+        keep = (fraction >= self.tissue_threshold) & (area > 0)
+        if region is not None:
+            # the center of the tile has to be in an annotation
+            center_x = np.clip(((xs + extent / 2) / tissue_downsample).astype(np.int64), 0, width - 1)
+            center_y = np.clip(((ys + extent / 2) / tissue_downsample).astype(np.int64), 0, height - 1)
+            keep &= region[center_y, center_x]
+        print(f'{np.count_nonzero(keep)} of {len(keep)} tiles contain tissue, '
+              f'{len(keep) - np.count_nonzero(keep)} background tiles are skipped.')
+
+        filename = os.path.basename(output_folder)
+        patch_jobs = []
+        for x, y in zip(xs[keep].tolist(), ys[keep].tolist()):
+            output_file_path = os.path.join(output_folder, f'{filename}_x{x}_y{y}{self.output_format.extension}')
+            patch_jobs.append((output_file_path, [[x, y], [x + extent, y], [x + extent, y + extent], [x, y + extent]]))
+        return patch_jobs
+
+
+def extract_tiles(file_path: str, output_path: str, xmls_path: str = None, staining: str = '',
+                  coord_annotation_tag: str = 'hotspot', level: int = 0, target_mpp: float = None,
+                  downsample: float = None, patch_size: int = 512, stride: int = None, tissue_threshold: float = 0.5,
+                  saturation_threshold: int = 20, tissue_level: int = None, overwrite: bool = False,
+                  workers: int = 1, patch_workers: int = 1, encode_workers: int = 1, output_format: str = 'png',
+                  compress_level: int = 6, quality: int = 90, match_rule: str = 'prefix', match_pattern: str = None,
+                  coalesce: bool = False, coalesce_memory: int = 256,
+                  profile: bool = False, cprofile: bool = False, dry_run: bool = False,
+                  max_memory: int = None, shard_index: int = None, shard_count: int = None, shard_by: str = 'hash'):
+    png_extractor = TilePngExtractor(file_path=file_path, output_path=output_path, xmls_path=xmls_path,
+                                     staining=staining, coord_annotation_tag=coord_annotation_tag, level=level,
+                                     target_mpp=target_mpp, downsample=downsample, patch_size=patch_size,
+                                     stride=stride, tissue_threshold=tissue_threshold,
+                                     saturation_threshold=saturation_threshold, tissue_level=tissue_level,
+                                     overwrite=overwrite, workers=workers, patch_workers=patch_workers,
+                                     encode_workers=encode_workers, output_format=output_format,
+                                     compress_level=compress_level, quality=quality, match_rule=match_rule,
+                                     match_pattern=match_pattern, coalesce=coalesce, coalesce_memory=coalesce_memory,
+                                     profile=profile, cprofile=cprofile, dry_run=dry_run,
+                                     max_memory=max_memory, shard_index=shard_index, shard_count=shard_count,
+                                     shard_by=shard_by)
+
+    # process the files
+    png_extractor.process_files()
+
+
+if __name__ == '__main__':
+    import fire
+    fire.Fire(extract_tiles)
@@ -1,21 +1,34 @@
 import os
-import numpy as np
+import time
+import cProfile
 import glob
-import fire
-from PIL import Image
-import platform
+import traceback
 
-# fix for windows
-if platform.system() == 'Windows':
-    print('INFO: Path to openslide ddl is manually added to the path.')
-    openslide_path = r'C:\Users\ls19k424\Documents\openslide-win64-20171122\bin'
-    os.environ['PATH'] = openslide_path + ";" + os.environ['PATH']
-import openslide
+from image_utils import resize_rgb, rgba_to_rgb
+from instrumentation import PROFILE_FILE_NAME, Profiler
+from lazy_imports import import_openslide, lazy_import, load
+from manifest import MANIFEST_FILE_NAME, JobManifest, file_signature, is_complete, json_coord, partial_file
+from output_writers import OutputFormat
+from pipeline import PatchPipeline
+from region_planner import (OPENSLIDE_CACHE_BYTES, READ_BYTES_PER_PIXEL, RGB_BYTES_PER_PIXEL, coalescing_report,
+                            get_tile_size, plan_regions)
+from sharding import SHARD_STRATEGIES, assign_shards, shard_file_name
+from thumbnail_cache import ThumbnailCache
+
+np = lazy_import('numpy')
+Image = lazy_import('PIL.Image')
+openslide = import_openslide()
+
+# tile size of the images that are streamed because they do not fit in the memory budget (halved until they fit)
+STREAM_TILE_SIZE = 2048
+MIN_STREAM_TILE_SIZE = 64
+# regions are read from the slide in strips of at most this many pixels (see read_rgb)
+READ_STRIP_PIXELS = 2 ** 22
 
 
 class PngExtractor:
     """
-    This Object extracts a whole mrxs file to a png format.
+    This Object extracts a whole mrxs file to a png (or another image) format.
 
     :param file_path: string
         path to the mrxs single file or folder of files.
@@ -26,10 +39,88 @@ class PngExtractor:
     :param level: int (optional)
         Level of the mrxs file that should be used for the conversion (default is 0).
     :param overwrite: overides exisiting extracted patches (default is False)
+    :param target_mpp: float (optional)
+        If set, the output has this resolution (microns per pixel) instead of the one of a level. The region is read
+        from the lowest resolution level that still has at least this resolution and resized (overrules level).
+    :param downsample: float (optional)
+        The same as target_mpp, but the resolution is given as downsample factor relative to level 0.
+    :param tile_size: int (optional)
+        If set, crops that are larger than tile_size x tile_size pixels are read tile by tile and streamed to the
+        output file, so the peak memory depends on the tile size (width x tile_size) and not on the crop size
+        (default is None, the whole crop is read at once).
+    :param workers: int (optional)
+        Number of processes the slides are distributed over (default is 1, the slides are processed one by one).
+    :param patch_workers: int (optional)
+        Number of threads that read the patches of one slide concurrently (default is 1).
+    :param encode_workers: int (optional)
+        Number of threads that encode and write the read patches concurrently (default is 1).
+    :param output_format: string (optional)
+        File format of the output: 'png', 'webp' (lossless), 'jpeg', 'tiff' (tiled) or 'npy' (default is 'png').
+    :param compress_level: int (optional)
+        zlib compression level of png and tiff files (0-9, default is 6). Lower is faster, higher is smaller.
+    :param quality: int (optional)
+        Quality of jpeg files (1-95, default is 90).
+    :param coalesce: bool (optional)
+        If True, patches of a slide that share tiles (e.g. neighbouring TMA cores, overlapping annotations) are read
+        together and sliced out of the combined read, so the tiles are only decoded once (default is False). On
+        levels > 0 the patches are aligned to the pixels of the level.
+    :param coalesce_memory: int (optional)
+        Maximal memory of a combined read and the patches sliced out of it in MB (default is 256).
+    :param thumbnail: bool (optional)
+        If True, a thumbnail of every slide is saved instead of a level (default is False). It is read from the lowest
+        resolution level that is still at least thumbnail_size large (or from an associated image of the slide).
+    :param thumbnail_size: int (optional)
+        Maximal width and height of the thumbnails (default is 1024).
+    :param associated_image: string (optional)
+        If set, the thumbnail is made from this image embedded in the slide (e.g. 'thumbnail', 'macro' or 'label')
+        instead of a level (default is None).
+    :param cache_path: string (optional)
+        Folder in which the thumbnails are cached (by slide path, size and modification time), so later runs only read
+        new or changed slides (default is None, no cache).
+    :param profile: bool (optional)
+        If True, the time, pixels and bytes of every stage (open_slide, read_region, rgba_to_rgb, resize, mask, encode,
+        write) of every patch and slide are recorded and saved to profile.json and profile.csv in the output folder,
+        with a summary of the throughput (default is False).
+    :param dry_run: bool (optional)
+        If True, the planned outputs (number of pixels, size and memory needed) are printed and nothing is extracted
+        (default is False).
+    :param max_memory: int (optional)
+        Memory budget in MB for the images that are held at the same time (it is shared by the workers and the
+        images of the patch pipeline of every worker). Images that would need more are read and streamed tile by tile,
+        or fail without stopping the batch if this is not possible (default is None, no budget).
+    :param cprofile: bool (optional)
+        If True, the run is profiled with cProfile and the statistics are saved to profile.prof in the output folder
+        (only the main process, use workers=1 to include the slides) (default is False).
+    :param shard_index: int (optional)
+        Index (0 to shard_count - 1) of the part of the slides that is processed, e.g. by one node of a cluster
+        (default is None, all the slides are processed).
+    :param shard_count: int (optional)
+        Number of parts the slides are split into. The shards write the manifest, match report and profile to
+        separate files in the shared output folder, see sharding.merge_shards (default is None).
+    :param shard_by: string (optional)
+        'hash': the slides are split by a stable hash of their path (relative to file_path), 'cost': by the number of
+        pixels of the level that is read, so the shards need about the same time (every shard opens all the slides
+        to estimate the costs) (default is 'hash').
 
+    The state of the run is recorded in a manifest in the output folder, so a re-run only processes new, changed
+    or failed slides and patches (unless overwrite is set).
     """
 
-    def __init__(self, file_path: str, output_path: str, staining: str = '', level: int = 0, overwrite: bool = False):
+    def __init__(self, file_path: str, output_path: str, staining: str = '', level: int = 0, overwrite: bool = False,
+                 target_mpp: float = None, downsample: float = None, tile_size: int = None, workers: int = 1,
+                 patch_workers: int = 1, encode_workers: int = 1, output_format: str = 'png', compress_level: int = 6,
+                 quality: int = 90, coalesce: bool = False, coalesce_memory: int = 256, thumbnail: bool = False,
+                 thumbnail_size: int = 1024, associated_image: str = None, cache_path: str = None,
+                 profile: bool = False, cprofile: bool = False, dry_run: bool = False, max_memory: int = None,
+                 shard_index: int = None, shard_count: int = None, shard_by: str = 'hash'):
+        if target_mpp and downsample:
+            raise ValueError('Specify either a target mpp or a downsample factor, not both.')
+        if (shard_index is None) != (shard_count is None):
+            raise ValueError('Specify both the shard index and the shard count.')
+        if shard_count is not None and not 0 <= shard_index < shard_count:
+            raise ValueError(f'The shard index has to be between 0 and {shard_count - 1}.')
+        if shard_by not in SHARD_STRATEGIES:
+            raise ValueError(f'Unknown shard strategy {shard_by}. Choose one of {", ".join(SHARD_STRATEGIES)}.')
         # initiate the mandatory elements
         self.file_path = file_path
         self.output_path = output_path
@@ -37,6 +128,28 @@ class PngExtractor:
         self.staining = staining
         self.level = level
         self.overwrite = overwrite
+        self.target_mpp = float(target_mpp) if target_mpp else None
+        self.downsample = float(downsample) if downsample else None
+        self.tile_size = tile_size
+        self.workers = workers
+        self.patch_workers = patch_workers
+        self.encode_workers = encode_workers
+        self.output_format = OutputFormat(output_format, compress_level=compress_level, quality=quality)
+        self.coalesce = coalesce
+        self.coalesce_memory = coalesce_memory
+        self.thumbnail = thumbnail
+        self.thumbnail_size = thumbnail_size
+        self.associated_image = associated_image
+        self.thumbnail_cache = ThumbnailCache(cache_path) if cache_path else None
+        self.profiler = Profiler(enabled=profile)
+        self.cprofile = cprofile
+        self.dry_run = dry_run
+        self.max_memory = max_memory
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.shard_by = shard_by
+        # open slide handles are reused from this pool (see conversion_worker.SlideHandlePool), if it is set
+        self.slide_pool = None
 
     @property
     def output_path(self):
@@ -45,8 +158,8 @@ class PngExtractor:
     @output_path.setter
     def output_path(self, output_path):
         # make the output folder if it does not exist
-        if not os.path.isdir(output_path):
-            os.makedirs(output_path)
+        # (the shards of a run may create it at the same time)
+        os.makedirs(output_path, exist_ok=True)
         self._output_path = output_path
 
     @property
@@ -58,84 +171,800 @@ class PngExtractor:
             files.extend(glob.glob(os.path.join(self.file_path, f'*{self.staining}.ndpi')))
         return files
 
+    @property
+    def manifest(self):
+        # loaded on first use, only the main process reads and writes the manifest
+        if getattr(self, '_manifest', None) is None:
+            self._manifest = JobManifest(self.output_path, self.shard_file_name(MANIFEST_FILE_NAME))
+        return self._manifest
+
+    def __getstate__(self):
+        # the manifest is not sent to the worker processes
+        state = self.__dict__.copy()
+        state.pop('_manifest', None)
+        return state
+
+    @property
+    def resolution_name(self):
+        # part of the output file names that states the resolution
+        if self.thumbnail:
+            return f'{self.associated_image if self.associated_image else "thumbnail"}{self.thumbnail_size}'
+        if self.target_mpp:
+            return f'mpp{self.target_mpp:g}'
+        if self.downsample:
+            return f'downsample{self.downsample:g}'
+        return f'level{self.level}'
+
+    @property
+    def job_params(self):
+        # the parameters that change the output, if they change the slides are processed again
+        params = {'level': self.level, **self.output_format.params}
+        if self.target_mpp:
+            params['target_mpp'] = self.target_mpp
+        if self.downsample:
+            params['downsample'] = self.downsample
+        if self.thumbnail:
+            params['thumbnail'] = {'size': self.thumbnail_size, 'associated_image': self.associated_image}
+        return params
+
     @property
     def files_to_process(self):
-        # we only have one file to process
-        if len(self.wsi_files) == 1:
-            filename = os.path.splitext(os.path.basename(self.file_path))[0]
-            output_file_name = os.path.join(self.output_path, f'{filename}-level{self.level}')
+        files_to_process = []
+        for wsi_path in self.select_shard(self.wsi_files):
+            filename = os.path.splitext(os.path.basename(wsi_path))[0]
+            output_file_name = os.path.join(self.output_path, f'{filename}-{self.resolution_name}')
             # skip existing files, if overwrite = False
-            if not self.overwrite and os.path.isfile(f'{output_file_name}.png'):
+            if self.is_processed((output_file_name, wsi_path)):
                 print(f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
-            else:
-                return [(output_file_name, self.file_path)]
+                continue
+            files_to_process.append((output_file_name, wsi_path))
 
-        # we have multiple files to process
-        else:
-            files_to_process = []
-            for wsi_path in self.wsi_files:
-                filename = os.path.splitext(os.path.basename(wsi_path))[0]
-                output_file_name = os.path.join(self.output_path, f'{filename}-level{self.level}')
-                # skip existing files, if overwrite = False
-                if not self.overwrite and os.path.isfile(f'{output_file_name}.png'):
-                    print(f'File {output_file_name} already exists. Output saving is skipped. To overwrite add --overwrite.')
-                    continue
-                files_to_process.append((output_file_name, wsi_path))
-
-            return files_to_process
+        return files_to_process
+
+    def shard_file_name(self, file_name):
+        # name of a file that every shard writes to the output folder (e.g. manifest.shard-2-of-4.json)
+        return shard_file_name(file_name, self.shard_index, self.shard_count)
+
+    def get_shard_key(self, wsi_path):
+        # the key a slide is assigned to a shard by, the same on every node (even if the input folder is mounted
+        # at another path)
+        if os.path.isdir(self.file_path):
+            return os.path.relpath(wsi_path, self.file_path).replace(os.sep, '/')
+        return os.path.basename(wsi_path)
+
+    def estimate_cost(self, wsi_path):
+        # estimated cost of a slide for shard_by='cost': the number of pixels of the level that is read
+        if self.thumbnail:
+            return 1
+        try:
+            wsi_img = openslide.open_slide(wsi_path)
+        except Exception:
+            # the error is reported by the shard that processes the slide
+            return 0
+        try:
+            width, height = wsi_img.level_dimensions[min(self.get_level(wsi_img), wsi_img.level_count - 1)]
+            return width * height
+        except Exception:
+            return 0
+        finally:
+            wsi_img.close()
+
+    def select_shard(self, wsi_paths):
+        # the slides of this shard (all the slides, if the batch is not sharded), in the original order
+        if self.shard_count is None:
+            return list(wsi_paths)
+        keys = {wsi_path: self.get_shard_key(wsi_path) for wsi_path in wsi_paths}
+        costs = None
+        if self.shard_by == 'cost':
+            costs = {key: self.estimate_cost(wsi_path) for wsi_path, key in keys.items()}
+        shards = assign_shards(sorted(set(keys.values())), self.shard_count, costs)
+        selected = [wsi_path for wsi_path in wsi_paths if shards[keys[wsi_path]] == self.shard_index]
+        print(f'Shard {self.shard_index} of {self.shard_count}: {len(selected)} of {len(keys)} slides.')
+        return selected
+
+    def get_key(self, output_file_name):
+        # key of a slide in the manifest
+        return os.path.relpath(output_file_name, self.output_path)
+
+    def get_inputs(self, *input_paths):
+        return [file_signature(path) for path in input_paths]
+
+    def is_processed(self, job):
+        # checks whether all the outputs of a slide (entry of files_to_process) are complete and up to date
+        # slides that are not in the manifest (processed by an older version) are checked with the output file
+        if self.overwrite:
+            return False
+        entry = self.manifest.get(self.get_key(job[0]))
+        if entry is None:
+            return is_complete(f'{job[0]}{self.output_format.extension}')
+        try:
+            inputs = self.get_inputs(*job[1:])
+        except OSError:
+            return False
+        return entry['status'] == 'done' and entry['params'] == self.job_params and entry['inputs'] == inputs
+
+    def is_patch_processed(self, output_file_path, coord, previous):
+        # checks whether a patch is complete and up to date, previous is the manifest entry of the slide (None if
+        # the slide is not in the manifest, then the output file is checked)
+        if self.overwrite:
+            return False
+        if previous is None:
+            return is_complete(output_file_path)
+        patch = previous['patches'].get(os.path.basename(output_file_path))
+        return patch is not None and patch['status'] == 'done' and patch['coord'] == json_coord(coord)
 
     def process_files(self):
         # process the full image
         if os.path.isfile(self.file_path) or os.path.isdir(self.file_path):
-            for output_file_path, wsi_path in self.files_to_process:
-                assert os.path.isfile(wsi_path)
-                wsi_img = openslide.open_slide(wsi_path)
-                # extract the patch
-                png = self.extract_crop(wsi_img)
-                # save the image
-                print(f'Saving image {output_file_path}.png')
-                Image.fromarray(png[:, :, :3]).save(f'{output_file_path}.png')
+            return self.process_batch(self.files_to_process)
 
         else:
             # Something went wrong
             print('mrxs paths are invalid.')
 
-    def extract_crop(self, wsi_img, coord=None):
-        # coordinates have to be in format [tl, tr, br, bl] ((0,0) is top-left)
-        # crop the region of interest from the mrxs file on the specified level
+    def process_file(self, output_file_path, wsi_path, previous=None):
+        # process a single slide (entry of files_to_process), returns the manifest entries of the patches
+        assert os.path.isfile(wsi_path)
+        if self.thumbnail:
+            return self.process_thumbnail(output_file_path, wsi_path)
+        wsi_img = self.open_slide(wsi_path)
+        try:
+            # extract and save the image
+            return self.process_patches(wsi_img, self.get_patch_jobs(wsi_img, output_file_path), previous)
+        finally:
+            self.close_slide(wsi_img)
+
+    def get_patch_jobs(self, wsi_img, output_file_path):
+        # returns a list of (output file path, coordinates) of the images of a slide: the whole slide
+        return [(f'{output_file_path}{self.output_format.extension}', None)]
+
+    def process_thumbnail(self, output_file_path, wsi_path):
+        # saves the thumbnail of a slide (copied from the cache, if the slide did not change since it was cached)
+        output_file_path = f'{output_file_path}{self.output_format.extension}'
+        if self.thumbnail_cache is not None and self.thumbnail_cache.load(wsi_path, self.job_params,
+                                                                           output_file_path):
+            print(f'Thumbnail {output_file_path} is copied from the cache.')
+        else:
+            print(f'Saving image {output_file_path}')
+            wsi_img = self.open_slide(wsi_path)
+            try:
+                img = self.extract_thumbnail(wsi_img)
+            finally:
+                self.close_slide(wsi_img)
+            self.write_crop(output_file_path, img)
+            if self.thumbnail_cache is not None:
+                self.thumbnail_cache.store(wsi_path, self.job_params, output_file_path)
+        return {os.path.basename(output_file_path): {'coord': None, 'status': 'done'}}
+
+    def extract_thumbnail(self, wsi_img):
+        # returns the thumbnail as RGB array, at most thumbnail_size x thumbnail_size pixels (the aspect ratio is kept)
+        if self.associated_image:
+            if self.associated_image not in wsi_img.associated_images:
+                raise ValueError(f'The slide has no {self.associated_image} image, it has: '
+                                 f'{", ".join(wsi_img.associated_images) or "none"}.')
+            img = rgba_to_rgb(wsi_img.associated_images[self.associated_image].convert('RGBA'))
+        else:
+            id_level = self.get_thumbnail_level(wsi_img)
+            img = self.read_rgb(wsi_img, (0, 0), id_level, wsi_img.level_dimensions[id_level])
+        height, width = img.shape[:2]
+        size = self.get_thumbnail_size((width, height))
+        with self.profiler.stage('resize', pixels=size[0] * size[1]):
+            return resize_rgb(img, size)
+
+    def get_thumbnail_level(self, wsi_img):
+        # the lowest resolution level that is still large enough, so only a small level is read
+        levels = [i for i, dims in enumerate(wsi_img.level_dimensions) if max(dims) >= self.thumbnail_size]
+        return levels[-1] if levels else 0
+
+    def get_thumbnail_size(self, size):
+        # size of the thumbnail of an image of size (width, height) pixels, the aspect ratio is kept
+        scale = min(1, self.thumbnail_size / max(size))
+        return max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale)))
+
+    def plan_thumbnail(self, wsi_img):
+        # plan of the thumbnail of a slide (as plan_image), the associated images are small and read to get their size
+        if self.associated_image:
+            if self.associated_image not in wsi_img.associated_images:
+                return {'strategy': 'invalid', 'pixels': 0, 'memory': 0,
+                        'error': f'The slide has no {self.associated_image} image.'}
+            size, downsample = wsi_img.associated_images[self.associated_image].size, None
+        else:
+            id_level = self.get_thumbnail_level(wsi_img)
+            size, downsample = wsi_img.level_dimensions[id_level], wsi_img.level_downsamples[id_level]
+        output_size = self.get_thumbnail_size(size)
+        return {'strategy': 'read', 'pixels': output_size[0] * output_size[1],
+                'memory': self.estimate_memory(size, output_size, downsample=downsample)}
+
+    def process_batch(self, files_to_process):
+        # process all the entries of files_to_process (tuples with the arguments of process_file), either one by
+        # one or distributed over a pool of processes. An error only fails the slide it occurred in.
+        # The result of every slide is recorded in the manifest.
+        # returns a dictionary with the slide path as key and None (success) or the error message as value
+        if self.dry_run:
+            self.plan_batch(files_to_process)
+            return {}
+        results = {}
+        start = time.perf_counter()
+        profile = cProfile.Profile() if self.cprofile else None
+        if profile is not None:
+            profile.enable()
+        previous_entries = [self._get_previous(job) for job in files_to_process]
+        if self.workers > 1 and len(files_to_process) > 1:
+            for job, error, patches, records in self._process_pool(list(zip(files_to_process, previous_entries))):
+                self.profiler.merge(records)
+                results[job[1]] = self._record(job, error, patches)
+        else:
+            for job, previous in zip(files_to_process, previous_entries):
+                error, patches, records = self._process_file_safely(job, previous)
+                self.profiler.merge(records)
+                results[job[1]] = self._record(job, error, patches)
+        self.manifest.save()
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(os.path.join(self.output_path, f'{self.shard_file_name(PROFILE_FILE_NAME)}.prof'))
+        if self.profiler.enabled:
+            self.profiler.save_report(self.output_path, time.perf_counter() - start, len(results),
+                                      file_name=self.shard_file_name(PROFILE_FILE_NAME))
+
+        failed = {wsi_path: error for wsi_path, error in results.items() if error}
+        print(f'Processed {len(results) - len(failed)}/{len(results)} slides successfully.')
+        for wsi_path, error in failed.items():
+            print(f'    {wsi_path}: {error}')
+        return results
+
+    def plan_batch(self, files_to_process):
+        # planning pass: computes the pixels, the (uncompressed) size and the memory needed by every output from the
+        # level dimensions and the coordinates, without reading any image data, and prints the estimate
+        # returns a dictionary with the output file path as key and the plan of the image as value
+        plans = {}
+        budget = self.memory_budget
+        for job in files_to_process:
+            try:
+                wsi_img = self.open_slide(job[1])
+                try:
+                    if self.thumbnail:
+                        slide_plans = {f'{job[0]}{self.output_format.extension}': self.plan_thumbnail(wsi_img)}
+                    else:
+                        patch_jobs = self.get_patch_jobs(wsi_img, job[0], *job[2:])
+                        slide_plans = {path: self.plan_image(wsi_img, coord) for path, coord in patch_jobs}
+                finally:
+                    self.close_slide(wsi_img)
+            except Exception as e:
+                print(f'Planning of {job[1]} failed: {type(e).__name__}: {e}')
+                continue
+            for path, plan in slide_plans.items():
+                if plan['strategy'] in ('refused', 'invalid'):
+                    print(f'    {path} is {plan["strategy"]}: {plan["error"]}')
+            pixels = sum(plan['pixels'] for plan in slide_plans.values())
+            print(f'{job[1]}: {len(slide_plans)} images, {pixels / 1e6:.1f} megapixels, '
+                  f'{3 * pixels / 2 ** 20:.1f} MB uncompressed, largest read '
+                  f'{max([plan["memory"] for plan in slide_plans.values()] + [0]) / 2 ** 20:.1f} MB.')
+            plans.update(slide_plans)
+
+        strategies = [plan['strategy'] for plan in plans.values()]
+        pixels = sum(plan['pixels'] for plan in plans.values())
+        print(f'Plan: {len(files_to_process)} slides, {len(plans)} images, {pixels / 1e6:.1f} megapixels, '
+              f'{3 * pixels / 2 ** 30:.2f} GB uncompressed, largest read '
+              f'{max([plan["memory"] for plan in plans.values()] + [0]) / 2 ** 20:.1f} MB'
+              f'{f" (budget {budget / 2 ** 20:.0f} MB per read)" if budget else ""}. '
+              f'{strategies.count("tiled")} images are read tile by tile, {strategies.count("refused")} are refused, '
+              f'{strategies.count("invalid")} are invalid.')
+        return plans
+
+    def plan_image(self, wsi_img, coord=None):
+        # plan of a single output: strategy ('read' at once, 'tiled', 'refused' or 'invalid'), pixels and memory
+        try:
+            top_left_coord, id_level, size = self.get_region(wsi_img, coord)
+        except ValueError as e:
+            return {'strategy': 'invalid', 'pixels': 0, 'memory': 0, 'error': str(e)}
+        output_size = self.get_output_size(wsi_img, id_level, size)
+        downsample = wsi_img.level_downsamples[id_level]
+        plan = {'pixels': output_size[0] * output_size[1]}
+        try:
+            tile_size = self.get_read_tile_size(size, output_size, downsample)
+        except MemoryError as e:
+            return {**plan, 'strategy': 'refused', 'memory': self.estimate_memory(size, output_size,
+                                                                                  downsample=downsample),
+                    'error': str(e)}
+        if tile_size and self.output_format.supports_streaming:
+            return {**plan, 'strategy': 'tiled', 'memory': self.estimate_memory(size, output_size, tile_size,
+                                                                                downsample)}
+        return {**plan, 'strategy': 'read', 'memory': self.estimate_memory(size, output_size, downsample=downsample)}
+
+    @property
+    def memory_budget(self):
+        # memory budget in bytes of one image: the slides of the workers are processed at the same time, and the patch
+        # pipeline of a slide holds up to PatchPipeline.max_images images (being read, queued or being encoded).
+        # The tile cache of openslide is taken from the budget of every worker.
+        if not self.max_memory:
+            return None
+        workers = max(1, self.workers)
+        return max(0, self.max_memory * 2 ** 20 - workers * OPENSLIDE_CACHE_BYTES) / (workers * self.images_per_slide)
+
+    @property
+    def images_per_slide(self):
+        # maximal number of images of a slide that are held at the same time (see process_patches)
+        if self.patch_workers > 1 or self.encode_workers > 1:
+            return PatchPipeline(read_workers=self.patch_workers, encode_workers=self.encode_workers).max_images
+        return 1
+
+    @staticmethod
+    def estimate_read_overhead(size, downsample=None):
+        # bytes that read_rgb holds besides the RGB output while it reads a region of size pixels (on a level with the
+        # downsample): the RGBA image and its copy of one strip, or of the whole region if it is read at once
+        # (downsample that is not an integer, or None, e.g. for an associated image)
+        pixels = size[0] * size[1]
+        if downsample is not None and float(downsample).is_integer():
+            strip_pixels = size[0] * max(1, READ_STRIP_PIXELS // max(1, size[0]))
+            if strip_pixels < pixels:
+                # measured (benchmarks/read_memory.py): the buffers of the previous strip are not always freed yet
+                return strip_pixels * READ_BYTES_PER_PIXEL
+        return pixels * (READ_BYTES_PER_PIXEL - RGB_BYTES_PER_PIXEL)
+
+    def estimate_memory(self, size, output_size, tile_size=None, downsample=None):
+        # bytes needed to extract a region of size pixels (on a level with the downsample) into an image of
+        # output_size pixels: the RGB image (of a whole strip of tiles, if tile_size is set), the transient memory of
+        # the read (see estimate_read_overhead) and the resized image
+        if tile_size:
+            rows = min(tile_size, size[1])
+            output_rows = max(1, rows * output_size[1] // max(1, size[1]))
+            return (size[0] * rows * RGB_BYTES_PER_PIXEL + self.estimate_read_overhead((min(tile_size, size[0]), rows),
+                                                                                         downsample)
+                    + output_size[0] * output_rows * RGB_BYTES_PER_PIXEL)
+        memory = size[0] * size[1] * RGB_BYTES_PER_PIXEL + self.estimate_read_overhead(size, downsample)
+        if tuple(output_size) != tuple(size):
+            memory += output_size[0] * output_size[1] * RGB_BYTES_PER_PIXEL
+        return memory
+
+    def get_read_tile_size(self, size, output_size, downsample=None):
+        # tile size with which a region is read and streamed (None: it is read at once). Regions larger than the
+        # tile size are streamed, and regions that do not fit in the memory budget are streamed with the largest
+        # tile size whose strips fit. Raises a MemoryError if the region does not fit in any way.
+        tile_size = None
+        if self.tile_size and (size[0] > self.tile_size or size[1] > self.tile_size):
+            tile_size = self.tile_size
+        budget = self.memory_budget
+        streaming = self.output_format.supports_streaming
+
+        def estimate(tile_size=None):
+            return self.estimate_memory(size, output_size, tile_size, downsample)
+
+        if budget is None or estimate(tile_size if streaming else None) <= budget:
+            return tile_size
+        if not streaming:
+            raise MemoryError(f'The image needs {estimate() / 2 ** 20:.0f} MB, more than the budget of '
+                              f'{budget / 2 ** 20:.0f} MB, and the {self.output_format.name} format can not be '
+                              f'written tile by tile.')
+        tile_size = tile_size if tile_size else STREAM_TILE_SIZE
+        while tile_size > MIN_STREAM_TILE_SIZE and estimate(tile_size) > budget:
+            tile_size //= 2
+        if estimate(tile_size) > budget:
+            raise MemoryError(f'A strip of {tile_size} rows of the image needs {estimate(tile_size) / 2 ** 20:.0f} MB, '
+                              f'more than the budget of {budget / 2 ** 20:.0f} MB.')
+        return tile_size
+
+    def _get_previous(self, job):
+        # the manifest entry of the slide, without the patches if the inputs or the parameters changed
+        if self.overwrite:
+            return None
+        previous = self.manifest.get(self.get_key(job[0]))
+        if previous is not None:
+            try:
+                inputs = self.get_inputs(*job[1:])
+            except OSError:
+                inputs = None
+            if previous['params'] != self.job_params or previous['inputs'] != inputs:
+                return {'patches': {}}
+        return previous
+
+    def _record(self, job, error, patches):
+        # stores the result of a slide in the manifest, returns the error message (None if successful)
+        failed = [name for name, patch in patches.items() if patch['status'] != 'done']
+        if not error and failed:
+            error = f'{len(failed)} of {len(patches)} patches failed: {", ".join(failed)}'
+        try:
+            inputs = self.get_inputs(*job[1:])
+        except OSError:
+            inputs = None
+        entry = {'inputs': inputs, 'params': self.job_params, 'status': 'failed' if error else 'done',
+                 'patches': patches}
+        if error:
+            entry['error'] = error
+        self.manifest.update(self.get_key(job[0]), entry)
+        return error
+
+    def process_patches(self, wsi_img, patch_jobs, previous=None):
+        # extracts and saves the patches (tuples of output file path and coordinates) of one slide
+        # the read stage (patch_workers threads sharing the slide handle: openslide is thread safe and releases the
+        # GIL while decoding) and the encode stage (encode_workers threads: PIL releases the GIL while encoding)
+        # are connected with a bounded queue, so reading, encoding and writing of the patches overlap
+        # returns the manifest entries of the patches (by file name), a failing patch does not stop the others
+        patches = {}
+        coords = {}
+        for output_file_path, coord in patch_jobs:
+            # skip existing files, if overwrite = False
+            if self.is_patch_processed(output_file_path, coord, previous):
+                print(f'File {output_file_path} already exists. Output saving is skipped. To overwrite add --overwrite.')
+                patches[os.path.basename(output_file_path)] = {'coord': json_coord(coord), 'status': 'done'}
+            else:
+                coords[output_file_path] = coord
+
+        def record(output_file_path, error=None):
+            patch = {'coord': json_coord(coords[output_file_path]), 'status': 'failed' if error else 'done'}
+            if error:
+                print(f'Saving image {output_file_path} failed: {type(error).__name__}: {error}')
+                patch['error'] = f'{type(error).__name__}: {error}'
+            patches[os.path.basename(output_file_path)] = patch
+
+        def read(group):
+            # reads a group of patches (a single patch, unless coalesce is set), returns the arguments of write
+            try:
+                if len(group) > 1:
+                    return self.read_crop_group(wsi_img, group)
+                with self.profiler.patch(os.path.basename(group[0][0])):
+                    item = self.read_crop(wsi_img, *group[0])
+            except Exception as e:
+                for output_file_path, _ in group:
+                    record(output_file_path, e)
+                return []
+            if item is None:
+                # the crop was streamed to the file
+                record(group[0][0])
+                return []
+            return [item]
+
+        def write(output_file_path, img):
+            try:
+                with self.profiler.patch(os.path.basename(output_file_path)):
+                    self.write_crop(output_file_path, img)
+                record(output_file_path)
+            except Exception as e:
+                record(output_file_path, e)
+
+        if self.coalesce:
+            groups = self.plan_reads(wsi_img, list(coords.items()))
+        else:
+            groups = [[job] for job in coords.items()]
+        if self.patch_workers > 1 or self.encode_workers > 1:
+            # the lazy modules are loaded before the threads use them
+            load(np, Image)
+            pipeline = PatchPipeline(read_workers=self.patch_workers, encode_workers=self.encode_workers)
+            pipeline.run(groups, read, write)
+        else:
+            for group in groups:
+                for item in read(group):
+                    write(*item)
+        return patches
+
+    def plan_reads(self, wsi_img, patch_jobs):
+        # groups the patches (tuples of output file path and coordinates) whose regions share tiles, see
+        # region_planner.plan_regions. Patches that are streamed tile by tile or whose region is invalid are read
+        # on their own. Returns a list of groups of patches and prints how many decoded tile bytes are saved.
+        groups, jobs, boxes = [], [], []
+        for job in patch_jobs:
+            try:
+                top_left_coord, id_level, size = self.get_region(wsi_img, job[1])
+                streamed = self.get_read_tile_size(size, self.get_output_size(wsi_img, id_level, size),
+                                                   wsi_img.level_downsamples[id_level]) is not None
+            except Exception:
+                # the error is recorded when the patch is read
+                groups.append([job])
+                continue
+            if streamed:
+                groups.append([job])
+                continue
+            jobs.append(job)
+            boxes.append(self.get_level_box(wsi_img, top_left_coord, id_level, size))
+        if not jobs:
+            return groups
+
+        id_level = self.get_level(wsi_img)
+        tile_size = get_tile_size(wsi_img, id_level)
+        # the combined reads also have to fit in the memory budget: the RGB combined read, the patches copied out of it
+        # and the transient memory of the read (of one strip, or of the whole combined read if it is read at once)
+        max_memory = min(self.coalesce_memory * 2 ** 20, self.memory_budget or float('inf'))
+        if float(wsi_img.level_downsamples[id_level]).is_integer():
+            overhead = READ_STRIP_PIXELS * READ_BYTES_PER_PIXEL
+            max_pixels = (max_memory - overhead) // RGB_BYTES_PER_PIXEL
+        else:
+            max_pixels = max_memory // READ_BYTES_PER_PIXEL
+        planned = plan_regions(boxes, tile_size, int(max(0, max_pixels)))
+        report = coalescing_report(boxes, planned, tile_size)
+        print(f'Coalesced {report["regions"]} regions into {report["reads"]} reads: {report["coalesced_tiles"]} '
+              f'instead of {report["tiles"]} tiles are decoded ({report["saved_bytes"] / 2 ** 20:.1f} MB saved).')
+        groups.extend([jobs[i] for i in group] for group in planned)
+        return groups
+
+    def get_level_box(self, wsi_img, top_left_coord, id_level, size):
+        # the region (x0, y0, x1, y1) in pixels of the level
+        downsample = wsi_img.level_downsamples[id_level]
+        x0, y0 = int(top_left_coord[0] / downsample), int(top_left_coord[1] / downsample)
+        return x0, y0, x0 + size[0], y0 + size[1]
+
+    def _process_pool(self, jobs):
+        # processes the jobs (tuples of an entry of files_to_process and its manifest entry) in a pool of worker
+        # processes and yields (job, error, patches, records) of every slide. At most one slide per process is
+        # submitted at a time, so if a worker process dies (e.g. crash in the openslide library) and breaks the pool,
+        # the slides that were running are known: they are processed again one by one in a process of their own (only
+        # the slide that crashes fails), and the slides that were not started continue in a new pool.
+        # only imported when needed (startup time of single slide jobs)
+        from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+        from concurrent.futures.process import BrokenProcessPool
+        pending = list(reversed(jobs))
+        while pending:
+            running, crashed = {}, []
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                while (pending or running) and not crashed:
+                    while pending and len(running) < self.workers:
+                        job, previous = pending.pop()
+                        running[executor.submit(self._process_file_safely, job, previous)] = (job, previous)
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    # after a crash, the results of all the slides that were running are collected
+                    broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+                    for future in list(running) if broken else done:
+                        job, previous = running.pop(future)
+                        try:
+                            error, patches, records = future.result()
+                        except BrokenProcessPool:
+                            crashed.append((job, previous))
+                            continue
+                        except Exception as e:
+                            error, patches, records = f'{type(e).__name__}: {e}', {}, []
+                            print(f'Processing of {job[1]} failed: {error}')
+                        yield job, error, patches, records
+            if len(crashed) == 1:
+                yield (crashed[0][0], *self._crashed(crashed[0][0]))
+                continue
+            for job, previous in crashed:
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    try:
+                        result = executor.submit(self._process_file_safely, job, previous).result()
+                    except BrokenProcessPool:
+                        result = self._crashed(job)
+                yield (job, *result)
+
+    @staticmethod
+    def _crashed(job):
+        # error, patches and records of a slide whose worker process died
+        error = 'The worker process died while processing the slide (e.g. crash in the openslide library).'
+        print(f'Processing of {job[1]} failed: {error}')
+        return error, {}, []
+
+    def _process_file_safely(self, job, previous=None):
+        # runs process_file and returns the error message (None if successful), the manifest entries of the
+        # patches and the profiler records of the slide instead of raising the error
+        self.profiler.slide = self.get_key(job[0])
+        start = time.perf_counter()
+        try:
+            error, patches = None, self.process_file(*job, previous=previous)
+        except Exception as e:
+            print(f'Processing of {job[1]} failed:')
+            traceback.print_exc()
+            error, patches = f'{type(e).__name__}: {e}', {}
+        self.profiler.add('slide', time.perf_counter() - start)
+        return error, patches, self.profiler.pop_records()
+
+    def open_slide(self, wsi_path):
+        with self.profiler.stage('open_slide'):
+            if self.slide_pool is not None:
+                return self.slide_pool.acquire(wsi_path)
+            return openslide.open_slide(wsi_path)
+
+    def close_slide(self, wsi_img):
+        if self.slide_pool is not None:
+            self.slide_pool.release(wsi_img)
+        else:
+            wsi_img.close()
+
+    def save_crop(self, wsi_img, output_file_path, coord=None):
+        # extracts the crop and saves it
+        item = self.read_crop(wsi_img, output_file_path, coord)
+        if item is not None:
+            self.write_crop(*item)
+
+    def read_crop(self, wsi_img, output_file_path, coord=None):
+        # read stage: returns the arguments of write_crop, or None if the crop was streamed to the file
+        # (large crops are streamed tile by tile if a tile size is set)
+        top_left_coord, id_level, size = self.get_region(wsi_img, coord)
+        tile_size = self.get_read_tile_size(size, self.get_output_size(wsi_img, id_level, size),
+                                            wsi_img.level_downsamples[id_level])
+        print(f'Saving image {output_file_path}')
+        if tile_size:
+            if self.output_format.supports_streaming:
+                self.save_crop_tiled(wsi_img, output_file_path, top_left_coord, id_level, size, coord, tile_size)
+                return None
+            print(f'The {self.output_format.name} format can not be written tile by tile, '
+                  f'{output_file_path} is read at once.')
+        return output_file_path, self.extract_crop(wsi_img, coord)
+
+    def read_crop_group(self, wsi_img, group):
+        # reads the regions of a group of patches (tuples of output file path and coordinates) at once and slices
+        # the patches out of the combined read, returns a list of arguments of write_crop
+        regions = [self.get_region(wsi_img, coord) for _, coord in group]
+        id_level = regions[0][1]
+        downsample = wsi_img.level_downsamples[id_level]
+        boxes = [self.get_level_box(wsi_img, *region) for region in regions]
+        x0, y0 = min(box[0] for box in boxes), min(box[1] for box in boxes)
+        x1, y1 = max(box[2] for box in boxes), max(box[3] for box in boxes)
+        # the location is always given in level 0 coordinates
+        location = (int(x0 * downsample), int(y0 * downsample))
+        combined = self.read_rgb(wsi_img, location, id_level, (x1 - x0, y1 - y0))
+
+        items = []
+        for (output_file_path, coord), (top_left_coord, _, size), box in zip(group, regions, boxes):
+            print(f'Saving image {output_file_path}')
+            with self.profiler.patch(os.path.basename(output_file_path)):
+                # copy, the patches can overlap and are masked in place
+                img = np.array(combined[box[1] - y0:box[3] - y0, box[0] - x0:box[2] - x0])
+                items.append((output_file_path, self.finish_crop(img, wsi_img, coord, top_left_coord, id_level, size)))
+        return items
+
+    def write_crop(self, output_file_path, img):
+        # encode and write stage, the file only gets its final name when it is complete
+        with partial_file(output_file_path) as temp_path, open(temp_path, 'wb') as f, \
+                self.profiler.encode(f, pixels=img.shape[0] * img.shape[1]) as output_file:
+            self.output_format.save(img, output_file)
+
+    def read_rgb(self, wsi_img, location, id_level, size, out=None):
+        # reads a region (location in level 0 pixels, size in pixels of the level) and converts it to RGB, transparent
+        # pixels are white (see image_utils.rgba_to_rgb). openslide returns a PIL image and numpy copies its pixels
+        # (np.asarray is not a view of a PIL image), so the region is read in strips of READ_STRIP_PIXELS: besides the
+        # RGB output only the RGBA image and its copy of one strip are held. The location of a strip is only exact
+        # if the downsample of the level is an integer, regions on other levels are read at once.
+        width, height = size
+        if out is None:
+            out = np.empty((height, width, 3), dtype=np.uint8)
+        downsample = wsi_img.level_downsamples[id_level]
+        rows = max(1, READ_STRIP_PIXELS // max(1, width)) if float(downsample).is_integer() else height
+        for y in range(0, height, rows):
+            strip_size = (width, min(rows, height - y))
+            pixels = strip_size[0] * strip_size[1]
+            # the location is always given in level 0 coordinates
+            strip_location = (location[0], location[1] + int(y * downsample))
+            with self.profiler.stage('read_region', pixels=pixels, nbytes=4 * pixels):
+                rgba = np.asarray(wsi_img.read_region(location=strip_location, level=id_level, size=strip_size))
+            with self.profiler.stage('rgba_to_rgb', pixels=pixels):
+                rgba_to_rgb(rgba, out=out[y:y + strip_size[1]])
+            del rgba
+        return out
+
+    def finish_crop(self, img, wsi_img, coord, top_left_coord, id_level, size, row_offset=0):
+        # resizes an extracted region of size pixels on the level to the target resolution and masks it
+        output_size = self.get_output_size(wsi_img, id_level, size)
+        with self.profiler.stage('resize', pixels=output_size[0] * output_size[1]):
+            img = resize_rgb(img, output_size)
+        with self.profiler.stage('mask', pixels=img.shape[0] * img.shape[1]):
+            return self.mask_region(img, wsi_img, coord, top_left_coord, id_level, row_offset=row_offset)
+
+    def get_target_downsample(self, wsi_img):
+        # downsample factor of the output relative to level 0
+        if self.downsample:
+            return self.downsample
+        if self.target_mpp:
+            mpp = wsi_img.properties.get(openslide.PROPERTY_NAME_MPP_X)
+            if not mpp:
+                raise ValueError('The slide has no resolution (mpp) property, use a downsample factor instead.')
+            return self.target_mpp / float(mpp)
+        return wsi_img.level_downsamples[self.level]
+
+    def get_level(self, wsi_img):
+        # the level that is read: the specified level, or (if a target resolution is set) the level with the largest
+        # downsample that is not larger than the target downsample (small rounding differences are ignored)
+        if not (self.target_mpp or self.downsample):
+            return self.level
+        target = self.get_target_downsample(wsi_img)
+        levels = [i for i, d in enumerate(wsi_img.level_downsamples) if d <= target * 1.001]
+        return levels[-1] if levels else 0
+
+    def get_output_size(self, wsi_img, id_level, size):
+        # size of the output for a region of size pixels on level id_level (resized if a target resolution is set)
+        scale = wsi_img.level_downsamples[id_level] / self.get_target_downsample(wsi_img)
+        if abs(scale - 1) < 1e-3:
+            return tuple(size)
+        return max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale)))
+
+    def get_region(self, wsi_img, coord=None):
+        # coordinates have to be in format [tl, tr, br, bl] ((0,0) is top-left) in level 0 pixels, or the vertices of a
+        # polygon (then its bounding box is used)
+        # returns the location (level 0), the level and the size of the region of interest on that level
         # get the level and the dimensions
-        # id_level = np.argmax(np.array(wsi_img.level_downsamples) == self.level)
-        id_level = self.level
+        id_level = self.get_level(wsi_img)
         dims = wsi_img.level_dimensions[id_level]
+        downsample = wsi_img.level_downsamples[id_level]
 
-        if coord:
-            top_left_coord = [int(i) for i in coord[0]]
-            width = coord[2][0] - coord[0][0]
-            height = coord[2][1] - coord[0][1]
-            size = (int(width), int(height))
-            # make sure the dimension we want to crop are within the image dimensions
-            assert coord[3][0] <= dims[0] and coord[3][1] <= dims[1]
+        if coord is not None:
+            coord = np.asarray(coord, dtype=np.float64)
+            if coord.ndim != 2:
+                raise ValueError(f'A region needs at least two corner coordinates, got {coord.tolist()}.')
+            (min_x, min_y), (max_x, max_y) = coord.min(axis=0), coord.max(axis=0)
+            top_left_coord = [int(min_x), int(min_y)]
+            # the location is given in level 0 pixels, the size in pixels of the level
+            size = (int((max_x - min_x) / downsample), int((max_y - min_y) / downsample))
+            # the region has to overlap the slide, the parts outside of the slide are white
+            width, height = wsi_img.dimensions
+            if max_x <= 0 or max_y <= 0 or min_x >= width or min_y >= height:
+                raise ValueError(f'The region ({min_x:.0f}, {min_y:.0f}) - ({max_x:.0f}, {max_y:.0f}) does not overlap '
+                                 f'the slide ({width} x {height} pixels).')
+            if size[0] <= 0 or size[1] <= 0:
+                raise ValueError(f'The region ({min_x:.0f}, {min_y:.0f}) - ({max_x:.0f}, {max_y:.0f}) is empty on '
+                                 f'level {id_level}.')
         else:
             # if no coordinates are specified, the whole image is exported
             top_left_coord = [0, 0]
             size = dims
 
-        # extract the region of interest
-        img = wsi_img.read_region(location=top_left_coord, level=id_level, size=size)
+        return top_left_coord, id_level, size
+
+    def extract_crop(self, wsi_img, coord=None):
+        # crop the region of interest from the mrxs file on the specified level (resized to the target resolution)
+        # returns a contiguous RGB array, transparent pixels are white
+        top_left_coord, id_level, size = self.get_region(wsi_img, coord)
 
-        # Convert to img
-        img = np.array(img)
-        img[img[:, :, 3] != 255] = 255
+        # extract the region of interest and convert it to RGB in one pass
+        img = self.read_rgb(wsi_img, top_left_coord, id_level, size)
+        # the remaining resize is done on the read of the smaller level
+        return self.finish_crop(img, wsi_img, coord, top_left_coord, id_level, size)
+
+    def mask_region(self, img, wsi_img, coord, top_left_coord, id_level, row_offset=0):
+        # hook to blank parts of an extracted region (e.g. outside of a polygon annotation), img holds the rows of
+        # the (resized) region starting at row_offset. Nothing is masked by default.
         return img
 
+    def save_crop_tiled(self, wsi_img, output_file_path, top_left_coord, id_level, size, coord=None, tile_size=None):
+        # reads the region in tiles of tile_size x tile_size (default is the tile_size of the extractor) and writes
+        # them strip by strip, so only one strip of (width x tile_size) pixels is held in memory
+        tile_size = tile_size if tile_size else self.tile_size
+        width, height = size
+        downsample = wsi_img.level_downsamples[id_level]
+        # if a target resolution is set, the strips are resized on their own: every output strip is computed from
+        # the rows of the region it covers (the fractional part is passed to the resize as box), so the result is
+        # the same as if the whole region was resized at once
+        output_width, output_height = self.get_output_size(wsi_img, id_level, size)
+        scale_y = height / output_height
+        output_strip_height = max(1, int(tile_size / scale_y))
+        with partial_file(output_file_path) as temp_path, \
+                self.output_format.open_stream(temp_path, output_width, output_height) as writer:
+            for output_y in range(0, output_height, output_strip_height):
+                output_end = min(output_y + output_strip_height, output_height)
+                # rows of the region that are covered by the output strip
+                y, end = int(output_y * scale_y), min(height, int(np.ceil(output_end * scale_y)))
+                strip = np.empty((end - y, width, 3), dtype=np.uint8)
+                for x in range(0, width, tile_size):
+                    tile_width = min(tile_size, width - x)
+                    # the location is always given in level 0 coordinates
+                    location = (int(top_left_coord[0] + x * downsample), int(top_left_coord[1] + y * downsample))
+                    self.read_rgb(wsi_img, location, id_level, (tile_width, end - y), out=strip[:, x:x + tile_width])
+                with self.profiler.stage('resize', pixels=output_width * (output_end - output_y)):
+                    strip = resize_rgb(strip, (output_width, output_end - output_y),
+                                       box=(0, output_y * scale_y - y, width, output_end * scale_y - y))
+                with self.profiler.stage('mask', pixels=strip.shape[0] * strip.shape[1]):
+                    strip = self.mask_region(strip, wsi_img, coord, top_left_coord, id_level, row_offset=output_y)
+                # encoding and writing of the rows (the streaming writers write to the file themselves)
+                with self.profiler.stage('encode', pixels=strip.shape[0] * strip.shape[1]):
+                    writer.write_rows(strip)
+
 
-def extract_whole_slide(file_path: str, output_path: str, staining: str = '', level: int = 0, overwrite: bool = False):
+def extract_whole_slide(file_path: str, output_path: str, staining: str = '', level: int = 0, overwrite: bool = False,
+                        tile_size: int = None, workers: int = 1, encode_workers: int = 1, output_format: str = 'png',
+                        compress_level: int = 6, quality: int = 90, target_mpp: float = None,
+                        downsample: float = None, thumbnail: bool = False, thumbnail_size: int = 1024,
+                        associated_image: str = None, cache_path: str = None, profile: bool = False,
+                        cprofile: bool = False, dry_run: bool = False, max_memory: int = None,
+                        shard_index: int = None, shard_count: int = None, shard_by: str = 'hash'):
     png_extractor = PngExtractor(file_path=file_path, output_path=output_path, staining=staining,
-                                 level=level, overwrite=overwrite)
+                                 level=level, overwrite=overwrite, target_mpp=target_mpp, downsample=downsample,
+                                 tile_size=tile_size, workers=workers,
+                                 encode_workers=encode_workers, output_format=output_format,
+                                 compress_level=compress_level, quality=quality, thumbnail=thumbnail,
+                                 thumbnail_size=thumbnail_size, associated_image=associated_image,
+                                 cache_path=cache_path, profile=profile, cprofile=cprofile, dry_run=dry_run,
+                                 max_memory=max_memory, shard_index=shard_index, shard_count=shard_count,
+                                 shard_by=shard_by)
 
     # process the files
     png_extractor.process_files()
 
 
 if __name__ == '__main__':
+    import fire
     fire.Fire(extract_whole_slide)